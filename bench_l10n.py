@@ -0,0 +1,89 @@
+# লোকালাইজেশন ক্যাটালগের মাইক্রোবেঞ্চমার্ক।
+#
+# আগের পদ্ধতি (প্রতিটি কলে চার ভাষার সব টেক্সট ফরম্যাট করে ডিকশনারি বানানো, তারপর একটি বেছে
+# নেওয়া এবং প্রতিবার কিবোর্ড নতুন করে তৈরি করা) আর ক্যাটালগের প্রতি হ্যান্ডলার খরচ তুলনা করে।
+# pixi_gpt_bot ইমপোর্টে এখন কোনো ক্লায়েন্ট তৈরি হয় না, তাই টোকেন বা API কী ছাড়াই চালানো যায়।
+#
+#     python bench_l10n.py [--number 20000]
+
+import argparse
+import json
+import os
+import timeit
+
+import pixi_gpt_bot as bot
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+
+def load_raw_catalog():
+    raw = {}
+    for filename in sorted(os.listdir(bot.LOCALES_DIR)):
+        if filename.endswith('.json'):
+            with open(os.path.join(bot.LOCALES_DIR, filename), encoding='utf-8') as f:
+                raw[filename[:-len('.json')]] = json.load(f)
+    return raw
+
+
+RAW = load_raw_catalog()
+LANGUAGE = 'bn'
+
+# প্রতিটি হ্যান্ডলার: (টেক্সট কী, ফরম্যাট মান, কিবোর্ড)
+HANDLERS = {
+    'send_welcome_message': ('welcome', {'user_name': 'Fahim', 'channel_link': bot.TELEGRAM_CHANNEL_LINK}, 'join_channel'),
+    'language_selection': ('choose_language', {}, 'languages'),
+    'handle_language_callback': ('language_set', {}, None),
+    'send_main_menu': ('main_menu', {}, 'main_menu'),
+    'handle_main_menu_callback': ('chat_mode_prompt', {}, None),
+    'handle_message': ('thinking', {}, None),
+    'account_info': ('account_info', {'user_name': 'Fahim', 'plan': 'Free', 'used': 3, 'limit': 15, 'points': 4}, None),
+    'generate_referral_code': (
+        'referral_info',
+        {'referral_link': 'https://t.me/PixiGPTBot?start=REF1', 'referral_code': 'REF1', 'points': 2},
+        None
+    ),
+}
+
+
+def legacy_keyboard(name, language):
+    # আগের হ্যান্ডলারগুলো প্রতিবার এভাবে কিবোর্ড বানাত
+    if name == 'languages':
+        return InlineKeyboardMarkup([
+            [InlineKeyboardButton(RAW[code]['language_name'], callback_data=f'lang_{code}')] for code in RAW
+        ])
+    if name == 'join_channel':
+        return InlineKeyboardMarkup([[InlineKeyboardButton("Join Channel", url=bot.TELEGRAM_CHANNEL_LINK)]])
+    return InlineKeyboardMarkup([[InlineKeyboardButton("💬 Chat with AI", callback_data='chat_ai')]])
+
+
+def legacy_call(key, values, keyboard):
+    messages = {code: texts[key].format(**values) for code, texts in RAW.items()}
+    text = messages.get(LANGUAGE, messages['en'])
+    if keyboard:
+        legacy_keyboard(keyboard, LANGUAGE)
+    return text
+
+
+def catalog_call(key, values, keyboard):
+    text = bot.catalog.text(LANGUAGE, key, **values)
+    if keyboard:
+        bot.catalog.keyboard(LANGUAGE, keyboard)
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare per-handler localization cost before and after the catalog.")
+    parser.add_argument('--number', type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{'handler':<28}{'before (us)':>14}{'after (us)':>14}{'speedup':>10}")
+    for handler, (key, values, keyboard) in HANDLERS.items():
+        assert legacy_call(key, values, keyboard) == catalog_call(key, values, keyboard)
+        before = min(timeit.repeat(lambda: legacy_call(key, values, keyboard), number=args.number, repeat=3))
+        after = min(timeit.repeat(lambda: catalog_call(key, values, keyboard), number=args.number, repeat=3))
+        before_us = before / args.number * 1e6
+        after_us = after / args.number * 1e6
+        print(f"{handler:<28}{before_us:>14.2f}{after_us:>14.2f}{before_us / after_us:>9.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,383 @@
+# নেটওয়ার্ক ছাড়া লোড টেস্ট ও বেঞ্চমার্ক।
+#
+# আসল হ্যান্ডলারগুলো (start, ভাষা বাছাই, chat_ai, handle_message, account_info) কৃত্রিম Update দিয়ে
+# application.process_update এর মাধ্যমে চালানো হয়। Bot API, জেমিনি ও Firestore এর জায়গায় লোকাল
+# নকল বসানো হয়, প্রতিটির লেটেন্সি বদলানো যায়। টোকেন বা API কী লাগে না।
+#
+#     python loadtest.py --users 200 --messages 5
+#     python loadtest.py --save-baseline loadtest_baseline.json
+#     python loadtest.py --baseline loadtest_baseline.json --max-regression 0.2   # CI: রিগ্রেশনে exit 1
+#
+# মেমোরি tracemalloc দিয়ে মাপা হয়, তাই থ্রুপুট আসল চালানোর চেয়ে কম দেখায়; তুলনা শুধু একই
+# সেটিংসের আগের ফলাফলের সাথে অর্থবহ।
+
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+from collections import Counter
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'PixiGPT', 'username': 'PixiGPTBot'}
+
+# বেসলাইনের সাথে তুলনার নিয়ম: True হলে বেশি ভালো, False হলে কম ভালো
+BASELINE_METRICS = {
+    'updates_per_sec': True,
+    'p50_ms': False,
+    'p95_ms': False,
+    'p99_ms': False,
+    'bot_api_calls_per_update': False,
+    'gemini_calls_per_answer': False,
+    'storage_calls_per_update': False,
+    'memory_per_user_kb': False,
+    'gemini_rejected': False,
+    'gemini_failed': False,
+    'gemini_timeouts': False,
+    'quota_rejections': False,
+}
+
+# এগুলো শূন্য না হলে রান ব্যর্থ: ফিরিয়ে দেওয়া মেসেজ দ্রুত শেষ হয়, তাই নাহলে থ্রুপুট বেড়েছে মনে হত
+FAILURE_METRICS = ('handler_errors', 'gemini_rejected', 'gemini_failed', 'gemini_timeouts', 'quota_rejections')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Drive the PixiGPT handlers with synthetic updates and fake upstreams.")
+    parser.add_argument('--users', type=int, default=100, help="number of simulated users (all active at once)")
+    parser.add_argument('--messages', type=int, default=5, help="chat messages per user after the menu flow")
+    parser.add_argument('--prompts', type=int, default=50, help="distinct prompts shared by all users")
+    parser.add_argument('--bot-latency', type=float, default=0.02, help="fake Bot API latency (seconds)")
+    parser.add_argument('--storage-latency', type=float, default=0.01, help="fake Firestore latency (seconds)")
+    parser.add_argument('--gemini-latency', type=float, default=0.3, help="fake Gemini total latency (seconds)")
+    parser.add_argument('--gemini-chunks', type=int, default=4, help="streamed chunks per answer")
+    parser.add_argument('--answer-words', type=int, default=80)
+    parser.add_argument('--no-stream', action='store_true', help="use generate instead of streaming")
+    parser.add_argument('--real-limits', action='store_true', help="keep the Telegram send rate limits")
+    parser.add_argument('--gemini-queue', type=int, help="GEMINI_MAX_QUEUE per plan (default: --users, so no message is rejected)")
+    parser.add_argument('--save-baseline', metavar='PATH')
+    parser.add_argument('--baseline', metavar='PATH')
+    parser.add_argument('--max-regression', type=float, default=0.2, help="allowed relative regression vs baseline")
+    return parser.parse_args()
+
+
+def configure_environment(args):
+    # pixi_gpt_bot ইমপোর্টের আগেই সেট করতে হয়
+    os.environ.setdefault('STORAGE_BACKEND', 'memory')
+    os.environ['STREAM_RESPONSES'] = '0' if args.no_stream else '1'
+    # প্রতিটি ইউজারের একসাথে একটিই মেসেজ চলে, তাই ইউজার সংখ্যার সমান সারিতে কোনো মেসেজ ফিরে যায় না
+    if args.gemini_queue:
+        os.environ['GEMINI_MAX_QUEUE'] = str(args.gemini_queue)
+    else:
+        os.environ.setdefault('GEMINI_MAX_QUEUE', str(args.users))
+    if not args.real_limits:
+        # না হলে থ্রুপুট শুধু শিডিউলারের ৩০ মেসেজ/সেকেন্ড সীমা মাপবে
+        os.environ['SEND_GLOBAL_RATE'] = '1000000'
+        os.environ['SEND_CHAT_RATE'] = '1000000'
+        os.environ['SEND_CHAT_BURST'] = '1000000'
+
+
+class FakeUsage:
+    def __init__(self, prompt_tokens, output_tokens):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+
+
+class FakeChunk:
+    def __init__(self, text, usage=None):
+        self.text = text
+        self.usage_metadata = usage
+
+
+class FakeGeminiModel:
+    def __init__(self, latency, chunks, answer_words):
+        self.latency = latency
+        self.chunks = max(1, chunks)
+        self.answer = ' '.join(f"word{i}" for i in range(answer_words))
+        self.calls = 0
+
+    async def generate_content_async(self, contents, stream=False):
+        self.calls += 1
+        usage = FakeUsage(len(str(contents)) // 4, len(self.answer) // 4)
+        if stream:
+            return self._stream(usage)
+        await asyncio.sleep(self.latency)
+        return FakeChunk(self.answer, usage)
+
+    async def _stream(self, usage):
+        words = self.answer.split(' ')
+        size = max(1, len(words) // self.chunks)
+        parts = [' '.join(words[i:i + size]) + ' ' for i in range(0, len(words), size)]
+        for index, part in enumerate(parts):
+            await asyncio.sleep(self.latency / len(parts))
+            yield FakeChunk(part, usage if index == len(parts) - 1 else None)
+
+
+def make_fake_storage(bot, latency):
+    class FakeFirestoreStorage(bot.MemoryStorage):
+        # MemoryStorage এর উপর প্রতিটি কলে Firestore এর মতো রাউন্ড-ট্রিপ দেরি
+        def __init__(self):
+            super().__init__()
+            self.calls = Counter()
+
+        async def _round_trip(self, name):
+            self.calls[name] += 1
+            if latency:
+                await asyncio.sleep(latency)
+
+        async def get_user(self, user_id):
+            await self._round_trip('get_user')
+            return await super().get_user(user_id)
+
+        async def write_users(self, dirty):
+            await self._round_trip('write_users')
+            await super().write_users(dirty)
+
+        async def write_referral(self, user_id, fields, referrer_id, points):
+            await self._round_trip('write_referral')
+            await super().write_referral(user_id, fields, referrer_id, points)
+
+        async def get_referral_credits(self, user_id):
+            await self._round_trip('get_referral_credits')
+            return await super().get_referral_credits(user_id)
+
+    return FakeFirestoreStorage()
+
+
+def make_fake_request(latency):
+    from telegram.request import BaseRequest
+
+    class FakeRequest(BaseRequest):
+        # Bot API এর নকল: কল গুনে রাখে আর টেলিগ্রামের মতো JSON ফেরত দেয়
+        def __init__(self):
+            self.calls = Counter()
+            self._message_id = 1000
+
+        @property
+        def read_timeout(self):
+            return None
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        def _message(self, chat_id, text, message_id=None):
+            if message_id is None:
+                self._message_id += 1
+                message_id = self._message_id
+            return {
+                'message_id': message_id, 'date': int(time.time()), 'text': text, 'from': BOT_USER,
+                'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'},
+            }
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                             connect_timeout=None, pool_timeout=None):
+            name = url.rsplit('/', 1)[-1]
+            self.calls[name] += 1
+            if latency:
+                await asyncio.sleep(latency)
+            params = request_data.parameters if request_data is not None else {}
+
+            if name == 'getMe':
+                result = BOT_USER
+            elif name == 'sendMessage':
+                result = self._message(int(params['chat_id']), params.get('text', ''))
+            elif name == 'editMessageText':
+                result = self._message(int(params['chat_id']), params.get('text', ''), int(params['message_id']))
+            elif name == 'getChatMember':
+                user_id = int(params['user_id'])
+                result = {'status': 'member', 'user': {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"}}
+            else:
+                result = True
+            return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    return FakeRequest()
+
+
+def user_json(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'language_code': 'en'}
+
+
+def message_update(update_id, user_id, text):
+    message = {
+        'message_id': update_id, 'date': int(time.time()), 'text': text,
+        'chat': {'id': user_id, 'type': 'private'}, 'from': user_json(user_id),
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def callback_update(update_id, user_id, data):
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id), 'from': user_json(user_id), 'chat_instance': str(user_id), 'data': data,
+            'message': {
+                'message_id': update_id, 'date': int(time.time()), 'text': 'menu',
+                'chat': {'id': user_id, 'type': 'private'}, 'from': BOT_USER,
+            },
+        },
+    }
+
+
+def user_script(user_id, index, messages, prompts):
+    # একজন ইউজারের পুরো পথ: /start -> ভাষা -> chat_ai -> প্রশ্ন -> /account
+    base = user_id * 1000
+    yield 'start', message_update(base, user_id, '/start')
+    yield 'language_callback', callback_update(base + 1, user_id, 'lang_bn')
+    yield 'chat_ai', callback_update(base + 2, user_id, 'chat_ai')
+    for n in range(messages):
+        yield 'message', message_update(base + 3 + n, user_id, f"question number {(index + n) % prompts}")
+    yield 'account', message_update(base + 3 + messages, user_id, '/account')
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run(args, bot):
+    from telegram import Update
+
+    request = make_fake_request(args.bot_latency)
+    model = FakeGeminiModel(args.gemini_latency, args.gemini_chunks, args.answer_words)
+    fake_storage = make_fake_storage(bot, args.storage_latency)
+    bot._storage = bot.InstrumentedStorage(fake_storage, 'fake-firestore')
+
+    application = bot.build_application(token='123456:LOADTEST', request=request, model_factory=lambda name: model)
+    await application.initialize()
+    await bot.post_init(application)
+
+    latencies = {}
+
+    async def drive_user(index):
+        user_id = 10_000 + index
+        for kind, data in user_script(user_id, index, args.messages, args.prompts):
+            update = Update.de_json(data, application.bot)
+            started = time.perf_counter()
+            await application.process_update(update)
+            latencies.setdefault(kind, []).append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    await asyncio.gather(*(drive_user(index) for index in range(args.users)))
+    elapsed = time.perf_counter() - started
+    memory_after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    await bot.post_shutdown(application)
+    await application.shutdown()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    updates = len(all_latencies)
+    messages = len(latencies.get('message', []))
+    def counter(metric, **labels):
+        return sum(
+            value for (name, items), value in bot.metrics.counters.items()
+            if name == metric and all(dict(items).get(key) == label for key, label in labels.items())
+        )
+
+    errors = counter('handler_errors_total')
+    quota_rejections = counter('quota_rejections_total')
+    # ব্যাকগ্রাউন্ড সারাংশ ফিরে গেলে ইউজারের উত্তরে প্রভাব পড়ে না
+    rejected = counter('gemini_rejected_total') - counter('gemini_rejected_total', plan=bot.SUMMARY_PLAN)
+    failed = bot.inference.failed
+    timeouts = bot.inference.timeouts
+    answered = max(0, messages - rejected - failed - timeouts - quota_rejections)
+    result = {
+        'updates': updates,
+        'elapsed_s': round(elapsed, 3),
+        'updates_per_sec': round(updates / elapsed, 1),
+        'messages_per_sec': round(messages / elapsed, 1),
+        'answered_messages': answered,
+        'answered_per_sec': round(answered / elapsed, 1),
+        'p50_ms': round(percentile(all_latencies, 0.50) * 1000, 1),
+        'p95_ms': round(percentile(all_latencies, 0.95) * 1000, 1),
+        'p99_ms': round(percentile(all_latencies, 0.99) * 1000, 1),
+        'bot_api_calls_per_update': round(sum(request.calls.values()) / updates, 2),
+        'gemini_calls_per_answer': round(model.calls / answered, 2) if answered else 0,
+        'storage_calls_per_update': round(sum(fake_storage.calls.values()) / updates, 2),
+        'memory_per_user_kb': round((memory_after - memory_before) / 1024 / args.users, 1),
+        'handler_errors': errors,
+        'gemini_rejected': rejected,
+        'gemini_failed': failed,
+        'gemini_timeouts': timeouts,
+        'quota_rejections': quota_rejections,
+    }
+    per_handler = {
+        kind: {
+            'count': len(values),
+            'p50_ms': round(percentile(values, 0.50) * 1000, 1),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 1),
+            'p99_ms': round(percentile(values, 0.99) * 1000, 1),
+        }
+        for kind, values in latencies.items()
+    }
+    return result, per_handler, request.calls, fake_storage.calls
+
+
+def compare(result, baseline, max_regression):
+    regressions = []
+    for key, higher_is_better in BASELINE_METRICS.items():
+        if key not in baseline or not baseline[key]:
+            continue
+        if key not in result:
+            continue
+        before, after = baseline[key], result[key]
+        change = (after - before) / before
+        if (-change if higher_is_better else change) > max_regression:
+            regressions.append(f"{key}: {before} -> {after} ({change * 100:+.1f}%)")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    configure_environment(args)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    bot = importlib.import_module('pixi_gpt_bot')
+
+    result, per_handler, api_calls, storage_calls = asyncio.run(run(args, bot))
+
+    print(f"{'handler':<20}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for kind, row in per_handler.items():
+        print(f"{kind:<20}{row['count']:>8}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+    print()
+    for key, value in result.items():
+        print(f"{key:<28}{value}")
+    print("bot api calls:", dict(api_calls))
+    print("storage calls:", dict(storage_calls))
+
+    failed = False
+    for key in FAILURE_METRICS:
+        if result[key]:
+            print(f"FAIL: {key} = {result[key]}")
+            failed = True
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
+        print(f"baseline saved to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.max_regression)
+        for line in regressions:
+            print("REGRESSION:", line)
+        if regressions:
+            failed = True
+        else:
+            print(f"no regressions beyond {args.max_regression * 100:.0f}% vs {args.baseline}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,114 +1,2477 @@
 import os
-import sqlite3 # SQLite কোড রাখা হয়েছে তবে Firebase ব্যবহার করা হবে
+import random
+import re
+import sqlite3 # লোকাল স্টোরেজ, কথোপকথন ও রেসপন্স ক্যাশের জন্য
 import asyncio
-from datetime import datetime, timedelta
+import bisect
+import contextlib
+import functools
+import hashlib
+import time
+import unicodedata
+import json
+import multiprocessing
+import signal
+import string
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty as QueueEmpty
+from datetime import datetime, timedelta, time as dt_time
+
+# --- স্টার্টআপ সময়ের হিসাব ---
+# কোল্ড স্টার্টে সময় কোথায় যায় দেখার জন্য: মডিউল ইমপোর্ট আর ক্লায়েন্ট তৈরির সময় আলাদা করে রাখা হয়।
+startup_timings = [] # (ধরন, নাম, সেকেন্ড); ধরন 'import' অথবা 'init'
+
+
+def record_startup(kind, name, started):
+    startup_timings.append((kind, name, time.perf_counter() - started))
+
+
+def startup_report():
+    sections = []
+    for kind in ('import', 'init'):
+        items = [(name, seconds) for item_kind, name, seconds in startup_timings if item_kind == kind]
+        details = ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in items)
+        sections.append(f"{kind} {sum(seconds for _, seconds in items) * 1000:.0f} ms ({details})")
+    return "Startup: " + "; ".join(sections)
+
 
 # টেলিগ্রাম বট লাইব্রেরি
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
+_started = time.perf_counter()
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
+from telegram.error import BadRequest, RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+    Application, CommandHandler, MessageHandler, CallbackQueryHandler, ChatMemberHandler, filters, ContextTypes
+)
+record_startup('import', 'telegram', _started)
+_module_import_started = time.perf_counter()
+
+# google.generativeai ও firebase_admin ভারী লাইব্রেরি, তাই এগুলো প্রথম দরকারের সময় ইমপোর্ট হয়
+# (get_model ও get_firebase_app দেখুন)
+
+# --- আপনার প্রয়োজনীয় তথ্য (এনভায়রনমেন্ট ভেরিয়েবল থেকে নেওয়া হবে) ---
+TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
+TELEGRAM_CHANNEL_ID = int(os.environ.get("TELEGRAM_CHANNEL_ID", "-1002161374444")) # আপনার চ্যানেলের আইডি
+TELEGRAM_CHANNEL_LINK = os.environ.get("TELEGRAM_CHANNEL_LINK", "https://t.me/pixigpt") # আপনার চ্যানেলের সম্পূর্ণ লিঙ্ক
+
+# কোটা সেটিংস
+FREE_MESSAGE_LIMIT = 15 # প্রতিদিন ফ্রি প্ল্যানে ১৫টি মেসেজ
+PREMIUM_MESSAGE_LIMIT = 999999999 # প্রিমিয়াম প্ল্যানে আনলিমিটেড মেসেজ
+
+# --- API কনফিগারেশন ---
+GOOGLE_GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY") 
+
+# জেমিনি ইনফারেন্স সেটিংস
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", "8")) # একসাথে সর্বোচ্চ কতগুলো জেমিনি কল চলবে
+GEMINI_MAX_QUEUE = int(os.environ.get("GEMINI_MAX_QUEUE", "64")) # কোনো প্ল্যানের এর বেশি অনুরোধ অপেক্ষায় থাকলে সেই প্ল্যানের নতুনগুলো ফিরিয়ে দেওয়া হবে
+GEMINI_TIMEOUT = float(os.environ.get("GEMINI_TIMEOUT", "60")) # প্রতিটি অনুরোধের টাইমআউট (সেকেন্ড)
+
+# স্ট্রিমিং সেটিংস
+STREAM_RESPONSES = os.environ.get("STREAM_RESPONSES", "1") == "1" # উত্তর আসার সাথে সাথে মেসেজ এডিট করে দেখানো
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.5")) # দুটি এডিটের মধ্যে ন্যূনতম বিরতি (সেকেন্ড)
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+
+# আউটবাউন্ড মেসেজ সেটিংস (টেলিগ্রামের নথিভুক্ত সীমা)
+SEND_GLOBAL_RATE = float(os.environ.get("SEND_GLOBAL_RATE", "30")) # সব চ্যাট মিলিয়ে প্রতি সেকেন্ডে সর্বোচ্চ মেসেজ
+SEND_CHAT_RATE = float(os.environ.get("SEND_CHAT_RATE", "1")) # একটি প্রাইভেট চ্যাটে প্রতি সেকেন্ডে মেসেজ
+SEND_GROUP_PER_MINUTE = float(os.environ.get("SEND_GROUP_PER_MINUTE", "20")) # একটি গ্রুপে প্রতি মিনিটে মেসেজ
+SEND_CHAT_BURST = int(os.environ.get("SEND_CHAT_BURST", "3")) # একটি চ্যাটে একটানা কয়টি মেসেজ অপেক্ষা ছাড়া যাবে
+THINKING_DELAY = float(os.environ.get("THINKING_DELAY", "0.4")) # এর মধ্যে উত্তর চলে এলে "Thinking..." পাঠানো হবে না
+
+# ইউজার প্রোফাইল ক্যাশ সেটিংস
+PROFILE_CACHE_TTL = float(os.environ.get("PROFILE_CACHE_TTL", "300")) # ক্যাশে থাকা প্রোফাইল কত সেকেন্ড পর আবার পড়া হবে
+PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", "10000")) # সর্বোচ্চ কতজন ইউজারের প্রোফাইল মেমোরিতে থাকবে
+PROFILE_FLUSH_INTERVAL = float(os.environ.get("PROFILE_FLUSH_INTERVAL", "2")) # পরিবর্তনগুলো কত সেকেন্ড পরপর লেখা হবে
+
+# স্টোরেজ সেটিংস
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "firestore") # firestore, sqlite অথবা memory
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "pixigpt.db") # sqlite ব্যাকএন্ডের ফাইল
+
+# চ্যানেল মেম্বারশিপ ক্যাশ সেটিংস
+MEMBERSHIP_MEMBER_TTL = float(os.environ.get("MEMBERSHIP_MEMBER_TTL", "3600")) # সদস্য নিশ্চিত হলে কত সেকেন্ড আবার চেক করা হবে না
+MEMBERSHIP_NON_MEMBER_TTL = float(os.environ.get("MEMBERSHIP_NON_MEMBER_TTL", "30")) # সদস্য না হলে কত সেকেন্ড পর আবার চেক হবে
+MEMBERSHIP_CACHE_SIZE = int(os.environ.get("MEMBERSHIP_CACHE_SIZE", "50000"))
+
+# কথোপকথনের মেমোরি সেটিংস
+CONVERSATION_MEMORY = os.environ.get("CONVERSATION_MEMORY", "1") == "1" # আগের মেসেজগুলো হিস্টোরি হিসেবে পাঠানো
+CONVERSATION_TOKEN_BUDGET = int(os.environ.get("CONVERSATION_TOKEN_BUDGET", "2000")) # হিস্টোরির সর্বোচ্চ আনুমানিক টোকেন
+CONVERSATION_MAX_TURNS = int(os.environ.get("CONVERSATION_MAX_TURNS", "20")) # প্রতি ইউজারের রিং বাফারে সর্বোচ্চ টার্ন
+CONVERSATION_MEMORY_LIMIT = int(os.environ.get("CONVERSATION_MEMORY_LIMIT", str(64 * 1024 * 1024))) # সব সেশনের মোট সীমা (বাইট)
+CONVERSATION_IDLE_TTL = float(os.environ.get("CONVERSATION_IDLE_TTL", "3600")) # এতক্ষণ অলস থাকলে সেশন মেমোরি থেকে সরানো হবে
+CONVERSATION_SUMMARY_WORDS = int(os.environ.get("CONVERSATION_SUMMARY_WORDS", "120")) # 0 হলে পুরনো টার্ন সারাংশ না করে বাদ দেওয়া
+CONVERSATION_SUMMARY_CONCURRENCY = int(os.environ.get("CONVERSATION_SUMMARY_CONCURRENCY", "1")) # একসাথে কতগুলো ব্যাকগ্রাউন্ড সারাংশ জেমিনিতে যাবে
+CONVERSATION_DB = os.environ.get("CONVERSATION_DB", "") # SQLite ফাইলের পাথ; খালি থাকলে শুধু মেমোরিতে
+
+# রেসপন্স ক্যাশ সেটিংস
+RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", "1") == "1" # একই প্রশ্নের উত্তর আবার জেমিনিকে না পাঠিয়ে ক্যাশ থেকে দেওয়া
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "2000")) # মেমোরিতে সর্বোচ্চ কতগুলো উত্তর
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", str(6 * 3600))) # একটি উত্তর কত সেকেন্ড বৈধ
+RESPONSE_CACHE_MAX_PROMPT_CHARS = int(os.environ.get("RESPONSE_CACHE_MAX_PROMPT_CHARS", "300")) # এর চেয়ে বড় প্রশ্ন ক্যাশ হবে না
+RESPONSE_CACHE_DB = os.environ.get("RESPONSE_CACHE_DB", "") # SQLite ফাইলের পাথ; খালি থাকলে শুধু মেমোরিতে
+
+# রেফারেল সেটিংস
+REFERRAL_POINTS = 2 # প্রতিটি সফল রেফারেলে রেফারার যত পয়েন্ট পায়
+REFERRAL_COUNTER_SHARDS = int(os.environ.get("REFERRAL_COUNTER_SHARDS", "10")) # পয়েন্ট কাউন্টারের শার্ড সংখ্যা
+
+# লোকালাইজেশন সেটিংস
+LOCALES_DIR = os.environ.get("LOCALES_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "locales"))
+DEFAULT_LANGUAGE = 'en'
+
+# ওয়েবহুক সেটিংস
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "") # বাইরের HTTPS ঠিকানা; দেওয়া থাকলে পোলিংয়ের বদলে ওয়েবহুক চলবে
+WEBHOOK_MODE = os.environ.get("WEBHOOK_MODE", "0") == "1" # WEBHOOK_URL ছাড়াই সার্ভার চালানো (লোকাল টেস্টের জন্য, setWebhook হবে না)
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("PORT", "8443")) # Heroku web ডাইনো PORT দেয়
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "") # X-Telegram-Bot-Api-Secret-Token হেডার যাচাই
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "1")) # আপডেট কতগুলো প্রসেসে ভাগ হবে
+WEBHOOK_SHUTDOWN_TIMEOUT = float(os.environ.get("WEBHOOK_SHUTDOWN_TIMEOUT", "25")) # বন্ধের সময় ওয়ার্কারের জন্য অপেক্ষা (সেকেন্ড)
+# চলমান আপডেট শেষ হওয়ার জন্য সর্বোচ্চ অপেক্ষা; বাকি সময়ে আউটবক্স ও প্রোফাইল ফ্লাশ হয়, তাই SHUTDOWN_TIMEOUT এর চেয়ে কম রাখতে হবে
+WEBHOOK_DRAIN_TIMEOUT = float(os.environ.get("WEBHOOK_DRAIN_TIMEOUT", "15"))
+
+# রক্ষণাবেক্ষণ জব সেটিংস
+MAINTENANCE_RESET_TIME = os.environ.get("MAINTENANCE_RESET_TIME", "00:05") # প্রতিদিন কখন (সার্ভারের লোকাল সময়, HH:MM) পুরনো কোটা রিসেট হবে
+MAINTENANCE_SWEEP_INTERVAL = float(os.environ.get("MAINTENANCE_SWEEP_INTERVAL", "600")) # অলস সেশন ও ক্যাশ পরিষ্কারের বিরতি (সেকেন্ড)
+
+# মেট্রিক্স সেটিংস
+WORKER_INDEX = None # ওয়েবহুক ওয়ার্কার প্রসেসে তার ক্রমিক নম্বর
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0")) # Prometheus /metrics এন্ডপয়েন্টের পোর্ট; 0 হলে বন্ধ
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_DUMP_PATH = os.environ.get("METRICS_DUMP_PATH", "") # দেওয়া থাকলে নির্দিষ্ট সময় পরপর JSON স্ন্যাপশট লেখা হবে
+METRICS_DUMP_INTERVAL = float(os.environ.get("METRICS_DUMP_INTERVAL", "60")) # JSON স্ন্যাপশটের বিরতি (সেকেন্ড)
+
+# অ্যাডমিনদের টেলিগ্রাম আইডি (কমা দিয়ে আলাদা), /stats কমান্ডের জন্য
+ADMIN_USER_IDS = {int(x) for x in os.environ.get("ADMIN_USER_IDS", "").split(",") if x.strip()}
+
+GEMINI_MODEL_NAME = os.environ.get("GEMINI_MODEL", "gemini-pro")
+
+# মডেল রাউটিং সেটিংস
+GEMINI_FAST_MODEL = os.environ.get("GEMINI_FAST_MODEL", "gemini-1.5-flash") # ফ্রি প্ল্যান ও ছোট প্রশ্নের মডেল
+GEMINI_STRONG_MODEL = os.environ.get("GEMINI_STRONG_MODEL", "gemini-1.5-pro") # প্রিমিয়ামের বড় প্রশ্নের মডেল
+GEMINI_FALLBACK_MODELS = os.environ.get("GEMINI_FALLBACK_MODELS", GEMINI_MODEL_NAME) # কমা দিয়ে আলাদা, শেষ ভরসা
+GEMINI_LONG_PROMPT_CHARS = int(os.environ.get("GEMINI_LONG_PROMPT_CHARS", "600")) # এর চেয়ে বড় প্রিমিয়াম প্রশ্ন শক্তিশালী মডেলে
+GEMINI_BREAKER_FAILURES = int(os.environ.get("GEMINI_BREAKER_FAILURES", "3")) # পরপর এতবার ব্যর্থ হলে মডেলটি সাময়িক বাদ
+GEMINI_BREAKER_COOLDOWN = float(os.environ.get("GEMINI_BREAKER_COOLDOWN", "30")) # কত সেকেন্ড পর আবার চেষ্টা
+GEMINI_PLAN_CONCURRENCY = os.environ.get("GEMINI_PLAN_CONCURRENCY", "") # যেমন "free:6"; খালি হলে ফ্রি = মোটের ৩/৪
+
+
+def check_environment():
+    # নিশ্চিত করুন প্রয়োজনীয় পরিবেশ ভেরিয়েবল সেট করা আছে (শুধু বট চালানোর সময়, ইমপোর্টে নয়)
+    if not TELEGRAM_BOT_TOKEN:
+        print("Error: TELEGRAM_BOT_TOKEN environment variable not set.")
+        exit(1)
+    if not GOOGLE_GEMINI_API_KEY:
+        print("Error: GEMINI_API_KEY environment variable not set.")
+        exit(1)
+    if STORAGE_BACKEND == 'firestore' and not FIREBASE_SERVICE_ACCOUNT_KEY:
+        print("Error: FIREBASE_SERVICE_ACCOUNT_KEY environment variable not set.")
+        print("Please add your Firebase service account JSON content as an environment variable.")
+        exit(1)
+
+
+# --- মেট্রিক্স ও ট্রেসিং ---
+# প্রতিটি হ্যান্ডলার ও বাইরের কল (জেমিনি, স্টোরেজ, Bot API) এর লেটেন্সি হিস্টোগ্রাম ও এরর কাউন্টার
+# এখানে জমা হয়। METRICS_PORT এ Prometheus টেক্সট ফরম্যাটে (/metrics) অথবা METRICS_DUMP_PATH এ
+# নির্দিষ্ট সময় পরপর JSON হিসেবে পাওয়া যায়। বিভিন্ন ক্লাসের stats() কালেক্টর হিসেবে gauge হয়ে যায়।
+
+METRICS_PREFIX = 'pixigpt'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # শেষেরটি +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in items)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(items, escaped)) + '}'
+
+
+def _metric_name(name):
+    # Prometheus নামে শুধু [a-zA-Z0-9_] চলে; মডেল বা জবের নামের '-', '.', স্পেস '_' হয়ে যায়
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+class Metrics:
+    def __init__(self, prefix=METRICS_PREFIX):
+        self.prefix = prefix
+        self.counters = {} # (নাম, লেবেল) -> মান
+        self.histograms = {} # (নাম, লেবেল) -> Histogram
+        self.collectors = [] # (নাম, stats ফাংশন)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        # {name}_seconds হিস্টোগ্রাম, আর এক্সেপশন হলে {name}_errors_total কাউন্টার
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.inc(f"{name}_errors_total", error=type(e).__name__, **labels)
+            raise
+        finally:
+            self.observe(f"{name}_seconds", time.perf_counter() - started, **labels)
+
+    def register(self, name, stats):
+        self.collectors.append((name, stats))
+
+    def _collected(self):
+        # মান সংখ্যা হলে সাধারণ gauge; (লেবেল, মান) জোড়ার লিস্ট হলে লেবেলসহ সিরিজ
+        for name, stats in self.collectors:
+            for key, value in stats().items():
+                full_name = _metric_name(f"{name}_{key}")
+                if isinstance(value, list):
+                    for labels, item in value:
+                        yield full_name, tuple(sorted(labels.items())), item
+                elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                    yield full_name, (), value
+
+    def render_prometheus(self):
+        lines = []
+        for name in sorted({name for name, _ in self.counters}):
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {full_name} counter")
+            for (counter_name, labels), value in self.counters.items():
+                if counter_name == name:
+                    lines.append(f"{full_name}{_format_labels(labels)} {value}")
+        for name in sorted({name for name, _ in self.histograms}):
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {full_name} histogram")
+            for (histogram_name, labels), histogram in self.histograms.items():
+                if histogram_name != name:
+                    continue
+                for bound, total in histogram.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f"{full_name}_bucket{_format_labels(labels, [('le', le)])} {total}")
+                lines.append(f"{full_name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{full_name}_count{_format_labels(labels)} {histogram.count}")
+        typed = set()
+        for name, labels, value in self._collected():
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {self.prefix}_{name} gauge")
+            lines.append(f"{self.prefix}_{name}{_format_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        return {
+            'time': time.time(),
+            'counters': [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in self.counters.items()
+            ],
+            'histograms': [
+                {
+                    'name': name, 'labels': dict(labels), 'count': histogram.count, 'sum': histogram.sum,
+                    'buckets': {str(bound): total for bound, total in histogram.cumulative()},
+                }
+                for (name, labels), histogram in self.histograms.items()
+            ],
+            'gauges': [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for name, labels, value in self._collected()
+            ],
+        }
+
+
+metrics = Metrics()
+
+
+def instrument(name):
+    # হ্যান্ডলারের মোট সময় ও এরর মাপার ডেকোরেটর
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update, context):
+            with metrics.timer('handler', handler=name):
+                return await handler(update, context)
+        return wrapper
+    return decorator
+
+
+def record_token_usage(response):
+    # জেমিনির usage_metadata (পুরনো SDK ভার্সনে নাও থাকতে পারে)
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return
+    for kind, field in (('prompt', 'prompt_token_count'), ('output', 'candidates_token_count')):
+        count = getattr(usage, field, 0) or 0
+        if count:
+            metrics.inc('gemini_tokens_total', count, kind=kind)
+
+
+class MetricsExporter:
+    def __init__(self, port, listen, dump_path, dump_interval):
+        self.port = port
+        self.listen = listen
+        self.dump_path = dump_path
+        self.dump_interval = dump_interval
+        self._server = None
+        self._dump_task = None
+
+    async def start(self, worker_index=None):
+        # একাধিক ওয়ার্কার প্রসেসে প্রতিটির নিজস্ব পোর্ট ও ফাইল
+        if self.port:
+            port = self.port + (worker_index or 0)
+            self._server = await asyncio.start_server(self._handle, self.listen, port)
+            print(f"Metrics endpoint is listening on {self.listen}:{port}/metrics")
+        if self.dump_path:
+            path = self.dump_path if worker_index is None else f"{self.dump_path}.{worker_index}"
+            self._dump_task = asyncio.ensure_future(self._dump_loop(path))
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                pass # হেডারগুলো দরকার নেই
+            parts = request_line.decode('latin-1').split()
+            path = parts[1].split('?')[0] if len(parts) > 1 else ''
+            if path == '/metrics':
+                status, content_type = '200 OK', 'text/plain; version=0.0.4; charset=utf-8'
+                body = metrics.render_prometheus().encode('utf-8')
+            elif path == '/metrics.json':
+                status, content_type = '200 OK', 'application/json'
+                body = json.dumps(metrics.snapshot()).encode('utf-8')
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain', b'not found\n'
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def _dump(self, path):
+        # আধা-লেখা ফাইল যেন কেউ না পড়ে, তাই আগে অস্থায়ী ফাইলে লিখে তারপর রিনেম
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(metrics.snapshot(), f)
+        os.replace(temp_path, path)
+
+    async def _dump_loop(self, path):
+        while True:
+            await asyncio.sleep(self.dump_interval)
+            try:
+                await asyncio.to_thread(self._dump, path)
+            except Exception as e:
+                print(f"Error writing metrics dump: {e!r}")
+
+    async def close(self):
+        if self._dump_task is not None:
+            self._dump_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._dump_task
+            self._dump_task = None
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+metrics_exporter = MetricsExporter(METRICS_PORT, METRICS_LISTEN, METRICS_DUMP_PATH, METRICS_DUMP_INTERVAL)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    # প্রতিটি Bot API কলের সময় মেথডের নাম অনুযায়ী মাপা হয়
+    async def post(self, url, *args, **kwargs):
+        with metrics.timer('bot_api_request', method=url.rsplit('/', 1)[-1]):
+            return await super().post(url, *args, **kwargs)
+
+
+# --- জেমিনি মডেল ---
+# মডেল অবজেক্ট নাম অনুযায়ী একবারই তৈরি হয়; প্রথম কলে google.generativeai ইমপোর্ট ও configure হয়।
+_genai = None
+_models = {}
+_models_lock = threading.Lock()
+
+
+def get_model(name=GEMINI_MODEL_NAME):
+    global _genai
+    with _models_lock:
+        model = _models.get(name)
+        if model is not None:
+            return model
+        if _genai is None:
+            if not GOOGLE_GEMINI_API_KEY:
+                raise RuntimeError("GEMINI_API_KEY environment variable not set.")
+            started = time.perf_counter()
+            import google.generativeai as genai
+            record_startup('import', 'google.generativeai', started)
+            genai.configure(api_key=GOOGLE_GEMINI_API_KEY)
+            _genai = genai
+        started = time.perf_counter()
+        model = _models[name] = _genai.GenerativeModel(name)
+        record_startup('init', f"model {name}", started)
+        return model
+
+
+# --- মডেল রাউটিং ---
+# ফ্রি ইউজারদের সব প্রশ্ন দ্রুত ও সস্তা মডেলে যায়; প্রিমিয়ামের বড় প্রশ্ন শক্তিশালী মডেলে, ছোটগুলো
+# দ্রুত মডেলে। প্রতিটি মডেলের একটি সার্কিট ব্রেকার থাকে: পরপর কয়েকবার ব্যর্থ হলে (কোটা শেষ হলে
+# সাথে সাথে) কিছুক্ষণ সেটি বাদ দিয়ে চেইনের পরের মডেলে পাঠানো হয়।
+
+# এই এররগুলোতে পরের মডেলে চেষ্টা করা হয় (google.api_core.exceptions এর নাম; লাইব্রেরিটি লেজি লোড হয়)
+FAILOVER_ERRORS = {
+    'ResourceExhausted', 'TooManyRequests', 'ServiceUnavailable', 'InternalServerError', 'GatewayTimeout',
+    'DeadlineExceeded', 'Aborted', 'Unknown', 'NotFound', 'TimeoutError',
+}
+QUOTA_ERRORS = {'ResourceExhausted', 'TooManyRequests'} # কোটা শেষ: ব্রেকার সাথে সাথে খুলে যায়
+
+
+def is_failover_error(error):
+    return type(error).__name__ in FAILOVER_ERRORS or isinstance(error, asyncio.TimeoutError)
+
+
+BREAKER_STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        # half_open অবস্থায় আবার চেষ্টা করতে দেওয়া হয়; সফল হলে বন্ধ, ব্যর্থ হলে আবার খোলা
+        return self.state != 'open'
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self, trip=False):
+        self.failures += 1
+        if trip or self.failures >= self.failure_threshold or self.opened_at is not None:
+            if self.state != 'open':
+                self.trips += 1
+            self.opened_at = time.monotonic()
+
+
+class ModelRouter:
+    def __init__(self, fast_model, strong_model, fallback_models, long_prompt_chars, failure_threshold, cooldown):
+        self.fast_model = fast_model
+        self.strong_model = strong_model
+        self.fallback_models = fallback_models
+        self.long_prompt_chars = long_prompt_chars
+        self.models = list(dict.fromkeys([fast_model, strong_model] + fallback_models))
+        self.breakers = {name: CircuitBreaker(failure_threshold, cooldown) for name in self.models}
+        self.failovers = 0
+
+    def primary(self, plan, prompt_chars):
+        if plan == 'premium' and prompt_chars >= self.long_prompt_chars:
+            return self.strong_model
+        return self.fast_model
+
+    def route(self, plan, prompt_chars):
+        # চেষ্টা করার ক্রম; খোলা ব্রেকারের মডেল বাদ, সব খোলা থাকলে অন্তত মূল মডেলটি
+        primary = self.primary(plan, prompt_chars)
+        chain = [primary]
+        if plan == 'premium':
+            chain += [self.fast_model, self.strong_model]
+        chain = list(dict.fromkeys(chain + self.fallback_models))
+        return [name for name in chain if self.breakers[name].allow()] or chain[:1]
+
+    def breaker(self, name):
+        if name not in self.breakers:
+            self.breakers[name] = CircuitBreaker(GEMINI_BREAKER_FAILURES, GEMINI_BREAKER_COOLDOWN)
+        return self.breakers[name]
+
+    def stats(self):
+        stats = {'failovers': self.failovers}
+        for name, breaker in self.breakers.items():
+            stats[f"{name} breaker"] = breaker.state
+            stats[f"{name} trips"] = breaker.trips
+        return stats
+
+    def metric_stats(self):
+        # মেট্রিক্সের জন্য মডেলের নাম লেবেলে, ব্রেকারের অবস্থা সংখ্যায় (BREAKER_STATES)
+        return {
+            'failovers': self.failovers,
+            'breaker_trips': [({'model': name}, breaker.trips) for name, breaker in self.breakers.items()],
+            'breaker_state': [
+                ({'model': name}, BREAKER_STATES[breaker.state]) for name, breaker in self.breakers.items()
+            ],
+        }
+
+
+def parse_plan_limits(value, max_concurrency):
+    # "free:6,premium:8" -> {'free': 6, 'premium': 8}; খালি থাকলে ফ্রি প্ল্যান মোটের তিন-চতুর্থাংশ
+    if not value.strip():
+        return {'free': max(1, max_concurrency * 3 // 4)}
+    limits = {}
+    for item in value.split(','):
+        plan, _, limit = item.partition(':')
+        if plan.strip() and limit.strip():
+            limits[plan.strip()] = int(limit)
+    return limits
+
+
+router = ModelRouter(
+    GEMINI_FAST_MODEL, GEMINI_STRONG_MODEL,
+    [name.strip() for name in GEMINI_FALLBACK_MODELS.split(',') if name.strip()],
+    GEMINI_LONG_PROMPT_CHARS, GEMINI_BREAKER_FAILURES, GEMINI_BREAKER_COOLDOWN,
+)
+
+
+# --- জেমিনি ইনফারেন্স লেয়ার ---
+# generate_content ব্লকিং কল, সরাসরি হ্যান্ডলারে চালালে পুরো ইভেন্ট লুপ আটকে যায়।
+# তাই সব কল এই এক্সিকিউটরের মাধ্যমে যায়: async API (না থাকলে সীমিত থ্রেড পুল),
+# প্রসেস-প্রতি ও প্ল্যান-প্রতি কনকারেন্সি সীমা, সীমিত অপেক্ষার সারি এবং প্রতি অনুরোধে টাইমআউট।
+# ব্যর্থ হলে রাউটারের চেইনের পরের মডেলে চেষ্টা হয় (স্ট্রিমে শুধু প্রথম চাঙ্কের আগে)।
+
+class InferenceOverloaded(Exception):
+    pass
+
+
+class InferenceExecutor:
+    def __init__(self, model_factory, router, max_concurrency, max_queue, timeout, plan_limits):
+        self.model_factory = model_factory
+        self.router = router
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # ফ্রি ট্রাফিকের ভিড়ে প্রিমিয়ামের জন্য সবসময় কিছু স্লট খালি থাকে
+        self._plan_semaphores = {plan: asyncio.Semaphore(limit) for plan, limit in plan_limits.items()}
+        self._models = {}
+        self._thread_pool = None
+
+        # কাউন্টার
+        self.queue_depth = 0
+        self.queue_depth_by_plan = {}
+        self.in_flight = 0
+        self.in_flight_by_plan = {}
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.total_first_chunk = 0.0
+        self.streams = 0
+
+    def model(self, name):
+        # প্রতিটি মডেল প্রথম কলে (অথবা post_init এর ওয়ার্ম-আপে) তৈরি হয়
+        model = self._models.get(name)
+        if model is None:
+            model = self.model_factory(name)
+            if not hasattr(model, 'generate_content_async') and self._thread_pool is None:
+                self._thread_pool = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='gemini')
+            self._models[name] = model
+        return model
+
+    def warm_up(self):
+        for name in self.router.models:
+            self.model(name)
+
+    def set_model_factory(self, model_factory):
+        self.model_factory = model_factory
+        self._models = {}
+
+    async def _acquire_slot(self, plan):
+        # প্ল্যানের সারি পূর্ণ হলে অপেক্ষা না করিয়ে সাথে সাথে ফিরিয়ে দেওয়া (ব্যাকপ্রেশার)।
+        # প্রতিটি প্ল্যানের নিজের সারি, যাতে ফ্রি ট্রাফিকের ভিড়ে প্রিমিয়াম ফিরে না যায়
+        if self.queue_depth_by_plan.get(plan, 0) >= self.max_queue:
+            self.rejected += 1
+            metrics.inc('gemini_rejected_total', plan=plan)
+            raise InferenceOverloaded()
+
+        queued_at = time.monotonic()
+        plan_semaphore = self._plan_semaphores.get(plan)
+        self.queue_depth += 1
+        self.queue_depth_by_plan[plan] = self.queue_depth_by_plan.get(plan, 0) + 1
+        try:
+            if plan_semaphore is not None:
+                await plan_semaphore.acquire()
+            try:
+                await self._semaphore.acquire()
+            except BaseException:
+                if plan_semaphore is not None:
+                    plan_semaphore.release()
+                raise
+        finally:
+            self.queue_depth -= 1
+            self.queue_depth_by_plan[plan] -= 1
+
+        started_at = time.monotonic()
+        self.total_wait += started_at - queued_at
+        metrics.observe('gemini_queue_wait_seconds', started_at - queued_at, plan=plan)
+        self.in_flight += 1
+        self.in_flight_by_plan[plan] = self.in_flight_by_plan.get(plan, 0) + 1
+        return started_at
+
+    def _release_slot(self, started_at, plan):
+        self.in_flight -= 1
+        self.in_flight_by_plan[plan] -= 1
+        self._semaphore.release()
+        if plan in self._plan_semaphores:
+            self._plan_semaphores[plan].release()
+        latency = time.monotonic() - started_at
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def _candidates(self, prompt, plan, models):
+        if models is None:
+            return self.router.route(plan, len(str(prompt)))
+        # স্লটের জন্য অপেক্ষার মধ্যে কোনো ব্রেকার খুলে গিয়ে থাকতে পারে
+        return [name for name in models if self.router.breaker(name).allow()] or models[:1]
+
+    def _record_failure(self, name, error, has_next):
+        self.router.breaker(name).record_failure(trip=type(error).__name__ in QUOTA_ERRORS)
+        if has_next:
+            self.router.failovers += 1
+            metrics.inc('gemini_failovers_total', model=name, error=type(error).__name__)
+            print(f"Gemini model {name} failed ({type(error).__name__}), trying the next model")
+
+    async def _call(self, name, prompt):
+        model = self.model(name)
+        if not hasattr(model, 'generate_content_async'):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._thread_pool, model.generate_content, prompt)
+        return await model.generate_content_async(prompt)
+
+    async def _stream_call(self, name, prompt):
+        model = self.model(name)
+        if hasattr(model, 'generate_content_async'):
+            response = await model.generate_content_async(prompt, stream=True)
+            async for chunk in response:
+                yield chunk
+            return
+
+        # async API না থাকলে থ্রেডে সিঙ্ক স্ট্রিম পড়ে asyncio.Queue দিয়ে চাঙ্ক পাঠানো
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        done = object()
+
+        def pump():
+            try:
+                for chunk in model.generate_content(prompt, stream=True):
+                    loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+                loop.call_soon_threadsafe(chunks.put_nowait, done)
+            except Exception as e:
+                loop.call_soon_threadsafe(chunks.put_nowait, e)
+
+        loop.run_in_executor(self._thread_pool, pump)
+        while True:
+            item = await chunks.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    async def generate(self, prompt, plan='free', models=None, on_model=None):
+        # on_model: যে মডেল আসলে উত্তর দিল তার নাম দিয়ে ডাকা হয় (ফেইলওভারের পর সেটি চেইনের পরের মডেল)
+        models = self._candidates(prompt, plan, models)
+        started_at = await self._acquire_slot(plan)
+        deadline = started_at + self.timeout
+        try:
+            for index, name in enumerate(models):
+                has_next = index + 1 < len(models)
+                try:
+                    with metrics.timer('gemini_request', mode='generate', model=name):
+                        response = await asyncio.wait_for(self._call(name, prompt), deadline - time.monotonic())
+                        text = response.text
+                except Exception as e:
+                    if not is_failover_error(e):
+                        raise
+                    self._record_failure(name, e, has_next)
+                    if not has_next or time.monotonic() >= deadline:
+                        raise
+                    continue
+                self.router.breaker(name).record_success()
+                record_token_usage(response)
+                if on_model is not None:
+                    on_model(name)
+                break
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self._release_slot(started_at, plan)
+
+        self.completed += 1
+        return text
+
+    async def _open_stream(self, prompt, models, deadline):
+        # প্রথম চাঙ্ক আসা পর্যন্ত মডেল বদলানো যায়; তারপর উত্তর মাঝপথে বদলানো যায় না
+        for index, name in enumerate(models):
+            has_next = index + 1 < len(models)
+            chunks = self._stream_call(name, prompt).__aiter__()
+            try:
+                first = await asyncio.wait_for(chunks.__anext__(), deadline - time.monotonic())
+            except StopAsyncIteration:
+                await chunks.aclose()
+                return name, chunks, None
+            except Exception as e:
+                await chunks.aclose()
+                if not is_failover_error(e):
+                    raise
+                self._record_failure(name, e, has_next)
+                if not has_next or time.monotonic() >= deadline:
+                    raise
+                continue
+            return name, chunks, first
+
+    async def stream(self, prompt, plan='free', models=None, on_model=None):
+        # টেক্সট চাঙ্কগুলো আসার সাথে সাথে yield করা হয়; পুরো স্ট্রিমের জন্য একটাই টাইমআউট
+        models = self._candidates(prompt, plan, models)
+        started_at = await self._acquire_slot(plan)
+        deadline = started_at + self.timeout
+        chunks = None
+        name = models[0]
+        last_chunk = None
+        try:
+            name, chunks, chunk = await self._open_stream(prompt, models, deadline)
+            if on_model is not None:
+                on_model(name)
+            self.total_first_chunk += time.monotonic() - started_at
+            self.streams += 1
+            metrics.observe('gemini_first_chunk_seconds', time.monotonic() - started_at, model=name)
+            while chunk is not None:
+                last_chunk = chunk
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # সেফটি ফিল্টার বা শেষ চাঙ্কে কোনো টেক্সট পার্ট থাকে না
+                    text = ''
+                if text:
+                    yield text
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), deadline - time.monotonic())
+                except StopAsyncIteration:
+                    chunk = None
+            self.router.breaker(name).record_success()
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            metrics.inc('gemini_request_errors_total', error='TimeoutError', mode='stream', model=name)
+            raise
+        except GeneratorExit:
+            raise
+        except Exception as e:
+            self.failed += 1
+            metrics.inc('gemini_request_errors_total', error=type(e).__name__, mode='stream', model=name)
+            raise
+        finally:
+            if chunks is not None:
+                await chunks.aclose()
+            self._release_slot(started_at, plan)
+            metrics.observe('gemini_request_seconds', time.monotonic() - started_at, mode='stream', model=name)
+
+        # স্ট্রিমে টোকেনের হিসাব শেষ চাঙ্কে থাকে
+        if last_chunk is not None:
+            record_token_usage(last_chunk)
+        self.completed += 1
+
+    def stats(self):
+        finished = self.completed + self.failed + self.timeouts
+        stats = {
+            'queue_depth': self.queue_depth,
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'failed': self.failed,
+            'timeouts': self.timeouts,
+            'rejected': self.rejected,
+            'avg_wait_ms': round(self.total_wait * 1000 / finished, 1) if finished else 0,
+            'avg_latency_ms': round(self.total_latency * 1000 / finished, 1) if finished else 0,
+            'max_latency_ms': round(self.max_latency * 1000, 1),
+            'avg_first_chunk_ms': round(self.total_first_chunk * 1000 / self.streams, 1) if self.streams else 0,
+        }
+        for plan, count in self.in_flight_by_plan.items():
+            stats[f"in_flight_{plan}"] = count
+        for plan, count in self.queue_depth_by_plan.items():
+            stats[f"queue_depth_{plan}"] = count
+        return stats
+
+
+# কথোপকথনের সারাংশ ব্যাকগ্রাউন্ডে চলে; নিজের ছোট সেমাফোর ও নিজের সারিতে থাকে, তাই
+# ইউজারদের প্ল্যানের স্লট বা সারির জায়গা নেয় না
+SUMMARY_PLAN = 'summary'
+
+inference = InferenceExecutor(
+    get_model, router, GEMINI_MAX_CONCURRENCY, GEMINI_MAX_QUEUE, GEMINI_TIMEOUT,
+    {SUMMARY_PLAN: CONVERSATION_SUMMARY_CONCURRENCY, **parse_plan_limits(GEMINI_PLAN_CONCURRENCY, GEMINI_MAX_CONCURRENCY)},
+)
+
+
+# --- আউটবাউন্ড মেসেজ শিডিউলার ---
+# টেলিগ্রাম সব চ্যাট মিলিয়ে সেকেন্ডে ~৩০টি এবং একটি চ্যাটে সেকেন্ডে ~১টি (গ্রুপে মিনিটে ২০টি)
+# মেসেজ নেয়, বেশি হলে 429 RetryAfter ফেরত দেয়। তাই সব reply/edit এই শিডিউলারের সারিতে যায়:
+# চ্যাট-প্রতি ক্রম ঠিক রেখে দুই স্তরের টোকেন বাকেট মেনে পাঠানো হয়, আসল উত্তর সাজসজ্জার
+# মেসেজের আগে যায়, একই মেসেজের জমে থাকা এডিটগুলো একটিতে মিলে যায় এবং নতুন মেসেজ এলে
+# তখনও না যাওয়া "Thinking..." বাদ পড়ে।
+
+PRIORITY_ANSWER = 0 # জেমিনির উত্তর ও সরাসরি জবাব
+PRIORITY_NORMAL = 1 # মেনু, স্বাগত বার্তা ইত্যাদি
+PRIORITY_DECORATIVE = 2 # "Thinking..." এর মতো বাদ দেওয়া যায় এমন মেসেজ
+SEND_MAX_ATTEMPTS = 5 # RetryAfter পেলে সর্বোচ্চ কতবার চেষ্টা
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now):
+        # পরের টোকেন পেতে আর কত সেকেন্ড বাকি
+        if now < self.updated:
+            return self.updated - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, until):
+        # RetryAfter: ওই সময় পর্যন্ত কিছু পাঠানো যাবে না, তারপর একটি মেসেজ
+        self.tokens = 1
+        self.updated = max(self.updated, until)
+
+    def full(self, now):
+        self._refill(now)
+        return now >= self.updated and self.tokens >= self.burst
+
+
+class OutboundOp:
+    __slots__ = ('chat_id', 'factory', 'priority', 'seq', 'collapse_key', 'droppable', 'future', 'queued_at', 'attempts')
+
+    def __init__(self, chat_id, factory, priority, seq, collapse_key, droppable, future):
+        self.chat_id = chat_id
+        self.factory = factory # প্রতিবার চেষ্টায় নতুন করে কল হয় এমন কোরুটিন ফ্যাক্টরি
+        self.priority = priority
+        self.seq = seq
+        self.collapse_key = collapse_key
+        self.droppable = droppable
+        self.future = future
+        self.queued_at = time.monotonic()
+        self.attempts = 0
+
+
+def _consume_result(future):
+    # কেউ অপেক্ষা না করলেও "exception was never retrieved" সতর্কতা এড়াতে
+    if not future.cancelled():
+        future.exception()
+
+
+class SendScheduler:
+    def __init__(self, global_rate, chat_rate, group_rate, chat_burst):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, max(1, global_rate))
+        self._queues = {} # chat_id -> deque[OutboundOp]
+        self._buckets = {} # chat_id -> TokenBucket
+        self._busy = set() # যে চ্যাটগুলোর একটি মেসেজ এই মুহূর্তে যাচ্ছে
+        self._sending = set()
+        self._seq = 0
+        self._wakeup = None
+        self._task = None
+        self._last_prune = time.monotonic()
+
+        # কাউন্টার
+        self.submitted = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.collapsed = 0
+        self.dropped = 0
+        self.total_queue_wait = 0.0
+        self.max_queue_wait = 0.0
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            # নেগেটিভ আইডি মানে গ্রুপ বা চ্যানেল
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self._buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    def pending(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def submit(self, chat_id, factory, priority=PRIORITY_NORMAL, collapse_key=None, droppable=False):
+        # সারিতে রেখে একটি future ফেরত দেয়; বাদ পড়লে future এর ফল None
+        self._ensure_started()
+        queue = self._queues.setdefault(chat_id, deque())
+
+        if collapse_key is not None:
+            for op in queue:
+                if op.collapse_key == collapse_key and not op.future.done():
+                    # একই মেসেজের আগের এডিট এখনো যায়নি: শুধু শেষ অবস্থাটা পাঠালেই চলে
+                    op.factory = factory
+                    op.priority = min(op.priority, priority)
+                    self.collapsed += 1
+                    return op.future
+
+        if not droppable:
+            for op in [op for op in queue if op.droppable]:
+                queue.remove(op)
+                self._drop(op)
+
+        self._seq += 1
+        future = asyncio.get_running_loop().create_future()
+        queue.append(OutboundOp(chat_id, factory, priority, self._seq, collapse_key, droppable, future))
+        self.submitted += 1
+        self._wakeup.set()
+        return future
+
+    def discard(self, chat_id, future):
+        # এখনো সারিতে থাকলে বাতিল করে True; পাঠানো শুরু হয়ে গেলে False
+        queue = self._queues.get(chat_id, ())
+        for op in queue:
+            if op.future is future:
+                queue.remove(op)
+                self._drop(op)
+                return True
+        return False
+
+    def _drop(self, op):
+        if not op.future.done():
+            op.future.set_result(None)
+        self.dropped += 1
+
+    async def reply(self, message, text, priority=PRIORITY_NORMAL, **kwargs):
+        future = self.submit(message.chat_id, lambda: message.reply_text(text, **kwargs), priority)
+        return await asyncio.shield(future)
+
+    def submit_edit(self, message, text, priority=PRIORITY_NORMAL, **kwargs):
+        future = self.submit(
+            message.chat_id, lambda: message.edit_text(text, **kwargs), priority,
+            collapse_key=('edit', message.chat_id, message.message_id),
+        )
+        future.add_done_callback(_consume_result)
+        return future
+
+    async def edit(self, message, text, priority=PRIORITY_NORMAL, **kwargs):
+        return await asyncio.shield(self.submit_edit(message, text, priority, **kwargs))
+
+    async def edit_query(self, query, text, priority=PRIORITY_NORMAL, **kwargs):
+        message = query.message
+        if message is None:
+            # ইনলাইন মেসেজের জন্য চ্যাট জানা থাকে না, ইউজারের চ্যাট ধরে নেওয়া হয়
+            future = self.submit(query.from_user.id, lambda: query.edit_message_text(text, **kwargs), priority)
+            return await asyncio.shield(future)
+        return await self.edit(message, text, priority, **kwargs)
+
+    def _next_op(self, now):
+        best = None
+        wait = None
+        for chat_id, queue in list(self._queues.items()):
+            while queue and queue[0].future.done():
+                queue.popleft()
+            if not queue:
+                if chat_id not in self._busy:
+                    del self._queues[chat_id]
+                continue
+            if chat_id in self._busy:
+                continue # একটি চ্যাটের মেসেজ একটার পর একটা যায়
+            delay = self._chat_bucket(chat_id).delay(now)
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            head = queue[0]
+            if best is None or (head.priority, head.seq) < (best.priority, best.seq):
+                best = head
+        return best, wait
+
+    def _prune(self, now):
+        # অনেকক্ষণ চুপ থাকা চ্যাটের বাকেট মুছে ফেলা, যাতে মেমোরি না বাড়ে
+        if now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        for chat_id in [c for c, bucket in self._buckets.items() if c not in self._queues and bucket.full(now)]:
+            del self._buckets[chat_id]
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            global_delay = self._global.delay(now)
+            if global_delay > 0:
+                op, wait = None, global_delay
+            else:
+                op, wait = self._next_op(now)
+
+            if op is None:
+                self._prune(now)
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._queues[op.chat_id].popleft()
+            self._global.take(now)
+            self._chat_bucket(op.chat_id).take(now)
+            queue_wait = now - op.queued_at
+            metrics.observe('outbound_queue_wait_seconds', queue_wait)
+            self.total_queue_wait += queue_wait
+            self.max_queue_wait = max(self.max_queue_wait, queue_wait)
+            self._busy.add(op.chat_id)
+            task = asyncio.ensure_future(self._send(op))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, op):
+        op.attempts += 1
+        try:
+            result = await op.factory()
+        except RetryAfter as e:
+            self.retried += 1
+            metrics.inc('outbound_retry_after_total')
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            print(f"Flood control in chat {op.chat_id}, retrying in {retry_after}s")
+            if op.attempts < SEND_MAX_ATTEMPTS and not op.future.done():
+                # একই চ্যাটের সারির মাথায় ফেরত, retry_after শেষ হওয়ার আগে ওই চ্যাটে কিছু যাবে না
+                self._chat_bucket(op.chat_id).pause(time.monotonic() + float(retry_after))
+                op.queued_at = time.monotonic()
+                self._queues.setdefault(op.chat_id, deque()).appendleft(op)
+            else:
+                self.failed += 1
+                if not op.future.done():
+                    op.future.set_exception(e)
+        except Exception as e:
+            self.failed += 1
+            if not op.future.done():
+                op.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not op.future.done():
+                op.future.set_result(result)
+        finally:
+            self._busy.discard(op.chat_id)
+            self._wakeup.set()
+
+    async def close(self, timeout=5.0):
+        # বন্ধের আগে সারিতে থাকা মেসেজগুলো পাঠানোর সুযোগ দেওয়া
+        deadline = time.monotonic() + timeout
+        while (self.pending() or self._sending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        for queue in self._queues.values():
+            for op in queue:
+                self._drop(op)
+        self._queues.clear()
+
+    def stats(self):
+        dispatched = self.sent + self.failed + self.retried
+        return {
+            'pending': self.pending(),
+            'sending': len(self._busy),
+            'submitted': self.submitted,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retry_after': self.retried,
+            'collapsed_edits': self.collapsed,
+            'dropped': self.dropped,
+            'avg_queue_wait_ms': round(self.total_queue_wait * 1000 / dispatched, 1) if dispatched else 0,
+            'max_queue_wait_ms': round(self.max_queue_wait * 1000, 1),
+        }
+
+
+outbox = SendScheduler(SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_GROUP_PER_MINUTE / 60, SEND_CHAT_BURST)
+
+
+class DelayedPlaceholder:
+    # "Thinking..." মেসেজটি THINKING_DELAY পরে সারিতে যায়; তার আগেই উত্তর তৈরি হলে কখনো পাঠানো হয় না
+    def __init__(self, reply_to, text, delay=THINKING_DELAY):
+        self.reply_to = reply_to
+        self.text = text
+        self._future = None
+        self._timer = asyncio.get_running_loop().call_later(delay, self._submit)
+
+    def _submit(self):
+        self._future = outbox.submit(
+            self.reply_to.chat_id, lambda: self.reply_to.reply_text(self.text),
+            PRIORITY_DECORATIVE, droppable=True,
+        )
+        self._future.add_done_callback(_consume_result)
+
+    async def take(self):
+        # উত্তর দেখানোর সময়: প্লেসহোল্ডার পাঠানো হয়ে থাকলে সেই মেসেজ, নাহলে None
+        if self._future is None:
+            self._timer.cancel()
+            return None
+        if outbox.discard(self.reply_to.chat_id, self._future):
+            return None
+        try:
+            return await asyncio.shield(self._future)
+        except Exception as e:
+            print(f"Could not send placeholder message: {e!r}")
+            return None
+
+
+# --- স্ট্রিমিং উত্তর ---
+# "Thinking..." মেসেজটিকেই ধাপে ধাপে এডিট করে উত্তর দেখানো হয়। টেলিগ্রামের এডিট রেট লিমিটের
+# জন্য এডিটগুলো একত্র করে STREAM_EDIT_INTERVAL পরপর শিডিউলারে পাঠানো হয় (সারিতে আটকে থাকা
+# পুরনো এডিট নতুনটিতে মিলে যায়), আর ৪০৯৬ অক্ষরের বেশি হলে বাকি অংশ নতুন মেসেজে চলে যায়।
+
+def split_message_text(text, limit=TELEGRAM_MAX_MESSAGE_LENGTH):
+    # সম্ভব হলে লাইন বা শব্দের শেষে কাটা
+    cut = text.rfind('\n', 0, limit)
+    if cut < limit // 2:
+        cut = text.rfind(' ', 0, limit)
+    if cut < limit // 2:
+        cut = limit
+    return text[:cut].rstrip(), text[cut:].lstrip()
+
+
+async def send_complete_reply(placeholder, reply_to, text):
+    # পুরো উত্তর আগে থেকেই জানা থাকলে (যেমন ক্যাশ থেকে) একই পথে প্লেসহোল্ডার এডিট বা নতুন মেসেজ
+    reply = StreamingReply(placeholder, reply_to)
+    await reply.push(text)
+    await reply.finish()
+
+
+class StreamingReply:
+    def __init__(self, placeholder, reply_to):
+        self.placeholder = placeholder # DelayedPlaceholder অথবা None
+        self.message = None # বর্তমানে যে মেসেজটি এডিট হচ্ছে
+        self.reply_to = reply_to
+        self.buffer = ''
+        self.shown_text = ''
+        self.last_edit = 0.0
+        self.total_length = 0
+        self.parts = []
+        self._pending_edit = None
+
+    async def push(self, text):
+        self.buffer += text
+        self.total_length += len(text)
+        self.parts.append(text)
+        while len(self.buffer) > TELEGRAM_MAX_MESSAGE_LENGTH:
+            head, rest = split_message_text(self.buffer)
+            self.buffer = head
+            await self._flush()
+            self.message = None
+            self.shown_text = ''
+            self.buffer = rest
+        if time.monotonic() - self.last_edit >= STREAM_EDIT_INTERVAL:
+            await self._flush()
+
+    async def finish(self):
+        await self._flush()
+        await self._settle()
+
+    @property
+    def text(self):
+        return ''.join(self.parts)
+
+    async def fail(self, error_text):
+        # কিছু দেখানো না হলে প্লেসহোল্ডারটিকেই এরর মেসেজে বদলে দেওয়া
+        await self._take_placeholder()
+        if self.total_length == 0 and self.message is not None:
+            await outbox.edit(self.message, error_text, PRIORITY_ANSWER)
+            return
+        await self._flush()
+        await outbox.reply(self.reply_to, error_text, PRIORITY_ANSWER)
+
+    async def _take_placeholder(self):
+        if self.placeholder is not None:
+            self.message = await self.placeholder.take()
+            self.placeholder = None
+
+    async def _settle(self):
+        # শেষ এডিটটি পৌঁছানো পর্যন্ত অপেক্ষা; মাঝের এডিটগুলো শিডিউলারে মিলে যেতে পারে
+        if self._pending_edit is None:
+            return
+        pending, self._pending_edit = self._pending_edit, None
+        try:
+            await asyncio.shield(pending)
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                raise
+
+    async def _flush(self):
+        text = self.buffer
+        if not text.strip() or text == self.shown_text:
+            return
+        await self._take_placeholder()
+        if self.message is None:
+            self.message = await outbox.reply(self.reply_to, text, PRIORITY_ANSWER)
+        else:
+            # এডিটের জন্য অপেক্ষা না করে জেমিনির স্ট্রিম পড়া চালিয়ে যাওয়া
+            self._pending_edit = outbox.submit_edit(self.message, text, PRIORITY_ANSWER)
+        self.shown_text = text
+        self.last_edit = time.monotonic()
+
+# --- Firebase সেটআপ ---
+# সার্ভিস অ্যাকাউন্ট পার্স করা ও firebase_admin ইমপোর্ট প্রথম দরকারের সময় একবারই হয়।
+FIREBASE_SERVICE_ACCOUNT_KEY = os.environ.get("FIREBASE_SERVICE_ACCOUNT_KEY")
+
+_firebase_app = None
+_firebase_lock = threading.Lock()
+
+
+def get_firebase_app():
+    global _firebase_app
+    with _firebase_lock:
+        if _firebase_app is not None:
+            return _firebase_app
+        if not FIREBASE_SERVICE_ACCOUNT_KEY:
+            raise RuntimeError("FIREBASE_SERVICE_ACCOUNT_KEY environment variable not set.")
+
+        started = time.perf_counter()
+        import firebase_admin
+        from firebase_admin import credentials, firestore_async # noqa: F401 (google.cloud.firestore এখানেই লোড হয়)
+        record_startup('import', 'firebase_admin', started)
+
+        started = time.perf_counter()
+        # Service Account Key একটি স্ট্রিং হিসেবে আসবে, এটিকে JSON অবজেক্টে রূপান্তর করতে হবে
+        cred = credentials.Certificate(json.loads(FIREBASE_SERVICE_ACCOUNT_KEY))
+        _firebase_app = firebase_admin.initialize_app(cred)
+        record_startup('init', 'firebase app', started)
+        print("Firebase initialized successfully.")
+        return _firebase_app
+
+
+def init_firestore():
+    from firebase_admin import firestore_async
+    app = get_firebase_app()
+    started = time.perf_counter()
+    client = firestore_async.client(app)
+    record_startup('init', 'firestore client', started)
+    return client
+
+# --- ইউজার প্রোফাইল ক্যাশ ---
+# একটি মেসেজে users/{id} একাধিকবার পড়া/লেখা হয়। তাই প্রোফাইলগুলো প্রসেসের মেমোরিতে
+# TTL ও LRU সহ রাখা হয়, একই ইউজারের একসাথে আসা লোডগুলো একটি রিডে মিলিয়ে দেওয়া হয়,
+# আর পরিবর্তিত ফিল্ডগুলো জমিয়ে PROFILE_FLUSH_INTERVAL পরপর একটি ব্যাচে লেখা হয়।
+
+class ProfileCache:
+    def __init__(self, loader, writer, ttl, max_size, flush_interval):
+        self._loader = loader
+        self._writer = writer
+        self.ttl = ttl
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self._entries = OrderedDict() # user_id -> (loaded_at, data)
+        self._loading = {} # user_id -> লোড টাস্ক
+        self._dirty = {} # user_id -> এখনো না লেখা ফিল্ড
+        self._flushing = {} # যে ফিল্ডগুলো এই মুহূর্তে লেখা হচ্ছে
+        self._credits = OrderedDict() # user_id -> (loaded_at, রেফারেল ক্রেডিটের মোট)
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+
+        # কাউন্টার
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.flushes = 0
+        self.flushed_users = 0
+        self.flush_errors = 0
+        self.credit_hits = 0
+        self.credit_loads = 0
+
+    async def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        task = self._loading.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._load(user_id))
+            self._loading[user_id] = task
+        # একজন অপেক্ষমাণ বাতিল হলেও বাকিদের জন্য লোড চলতে থাকবে
+        return await asyncio.shield(task)
+
+    async def _load(self, user_id):
+        try:
+            self.loads += 1
+            data = await self._loader(user_id)
+            # এখনো না লেখা পরিবর্তনগুলো স্টোর থেকে আসা ডেটার উপর বসানো
+            for pending in (self._flushing.get(user_id), self._dirty.get(user_id)):
+                if pending:
+                    data = {**(data or {}), **pending}
+            self._store(user_id, data)
+            return data
+        finally:
+            del self._loading[user_id]
+
+    def _store(self, user_id, data):
+        self._entries[user_id] = (time.monotonic(), data)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def referral_credits(self, user_id, loader):
+        # শার্ডগুলো পড়া প্রতি /account এ কয়েকটি রিড, তাই মোটটা প্রোফাইলের মতোই TTL পর্যন্ত রাখা হয়
+        entry = self._credits.get(user_id)
+        if entry is not None and time.monotonic() - entry[0] < self.ttl:
+            self._credits.move_to_end(user_id)
+            self.credit_hits += 1
+            return entry[1]
+
+        self.credit_loads += 1
+        points = await loader(user_id)
+        self._credits[user_id] = (time.monotonic(), points)
+        self._credits.move_to_end(user_id)
+        while len(self._credits) > self.max_size:
+            self._credits.popitem(last=False)
+        return points
+
+    def add_referral_credits(self, user_id, points):
+        # এই প্রসেস নিজে পয়েন্ট দিলে ক্যাশের মোটও বাড়ানো; অন্য প্রসেসের দেওয়া পয়েন্ট TTL শেষে আসে
+        entry = self._credits.get(user_id)
+        if entry is not None:
+            self._credits[user_id] = (entry[0], entry[1] + points)
+
+    def update(self, user_id, fields):
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            if entry[1] is None:
+                self._entries[user_id] = (entry[0], dict(fields))
+            else:
+                entry[1].update(fields)
+        self._dirty.setdefault(user_id, {}).update(fields)
+
+    async def write_now(self, user_id, fields, writer):
+        # কিছু পরিবর্তন (যেমন রেফারেল) অন্য ডকুমেন্টের সাথে একই ব্যাচে এখনই লিখতে হয়।
+        # ইউজারের জমে থাকা ফিল্ডগুলোও সাথে যায়, আর চলমান ফ্লাশ শেষ হওয়ার পরেই লেখা হয়
+        # যাতে পুরনো মান পরে এসে নতুনটিকে মুছে না দেয়।
+        entry = self._entries.get(user_id)
+        previous = {}
+        if entry is not None and entry[1] is not None:
+            previous = {key: entry[1].get(key) for key in fields}
+            entry[1].update(fields)
+
+        async with self._flush_lock:
+            pending = self._dirty.pop(user_id, {})
+            try:
+                await writer({**pending, **fields})
+            except Exception:
+                self._dirty[user_id] = {**pending, **self._dirty.get(user_id, {})}
+                if entry is not None and entry[1] is not None:
+                    entry[1].update(previous)
+                raise
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            self._flushing = dirty
+            try:
+                await self._writer(dirty)
+                self.flushes += 1
+                self.flushed_users += len(dirty)
+            except Exception as e:
+                self.flush_errors += 1
+                print(f"Error flushing {len(dirty)} user profiles: {e!r}")
+                # পরের বার আবার চেষ্টা করার জন্য ফেরত রাখা (নতুন পরিবর্তন অগ্রাধিকার পাবে)
+                for user_id, fields in dirty.items():
+                    self._dirty[user_id] = {**fields, **self._dirty.get(user_id, {})}
+            finally:
+                self._flushing = {}
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # লুপ বাতিল হলেও চলমান লেখা মাঝপথে থামবে না
+            await asyncio.shield(self.flush())
+
+    def start(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_loop())
+
+    def sweep(self):
+        # মেয়াদ শেষ হওয়া প্রোফাইল সরানো; না লেখা পরিবর্তন _dirty তে থাকে, তাই হারায় না
+        now = time.monotonic()
+        expired = [user_id for user_id, (loaded_at, _) in self._entries.items() if now - loaded_at >= self.ttl]
+        for user_id in expired:
+            del self._entries[user_id]
+        expired_credits = [user_id for user_id, (loaded_at, _) in self._credits.items() if now - loaded_at >= self.ttl]
+        for user_id in expired_credits:
+            del self._credits[user_id]
+        return len(expired) + len(expired_credits)
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._flush_task
+            self._flush_task = None
+        await self.flush()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'dirty': len(self._dirty),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 3) if lookups else 0,
+            'loads': self.loads,
+            'flushes': self.flushes,
+            'flushed_users': self.flushed_users,
+            'flush_errors': self.flush_errors,
+            'credit_hits': self.credit_hits,
+            'credit_loads': self.credit_loads,
+        }
+
+
+# --- স্টোরেজ ব্যাকএন্ড ---
+# ProfileCache এর নিচে ডেটা কোথায় থাকবে তা STORAGE_BACKEND দিয়ে বেছে নেওয়া হয়:
+#   firestore - Firestore এর AsyncClient (ডিফল্ট)
+#   sqlite    - এক সার্ভারে চালানোর জন্য WAL মোডে লোকাল SQLite ফাইল
+#   memory    - শুধু মেমোরিতে, টেস্ট ও অফলাইন চালানোর জন্য
+# সব ব্যাকএন্ডের একই মেথড: get_user, write_users (ইউজার -> ফিল্ড, merge করে এক ব্যাচে),
+# write_referral (রেফারেল ও পয়েন্ট একসাথে), get_referral_credits, reset_daily_counts (quota_day
+# ঠিক সেই দিনের ও গণনা শূন্য নয় এমন ইউজারদের পাতা ধরে রিসেট করে প্রতি ব্যাচে কতজন হলো তা yield করে), close।
+
+# ডেটাবেজ স্ট্রাকচার: users/user_id -> {telegram_name, language, plan_type, daily_message_count, quota_day, referral_code, referred_by_id, referral_points}
+
+FIRESTORE_BATCH_LIMIT = 500 # একটি Firestore ব্যাচে সর্বোচ্চ লেখা
+RESET_BATCH_SIZE = FIRESTORE_BATCH_LIMIT # দৈনিক রিসেটে প্রতি পাতায় কতজন ইউজার (সব ব্যাকএন্ডে)
+
+
+class FirestoreStorage:
+    def __init__(self, client):
+        from firebase_admin import firestore
+        self.client = client
+        self._increment = firestore.Increment
+
+    def _user(self, user_id):
+        return self.client.collection('users').document(str(user_id))
+
+    async def get_user(self, user_id):
+        doc = await self._user(user_id).get()
+        if doc.exists:
+            return doc.to_dict()
+        return None
+
+    async def write_users(self, dirty):
+        items = list(dirty.items())
+        for start in range(0, len(items), FIRESTORE_BATCH_LIMIT):
+            batch = self.client.batch()
+            for user_id, fields in items[start:start + FIRESTORE_BATCH_LIMIT]:
+                batch.set(self._user(user_id), fields, merge=True)
+            await batch.commit()
+
+    async def write_referral(self, user_id, fields, referrer_id, points):
+        shard = self._user(referrer_id).collection('referral_shards').document(
+            str(random.randrange(REFERRAL_COUNTER_SHARDS))
+        )
+        batch = self.client.batch()
+        batch.set(self._user(user_id), fields, merge=True)
+        batch.set(shard, {'points': self._increment(points)}, merge=True)
+        await batch.commit()
+
+    async def get_referral_credits(self, user_id):
+        total = 0
+        async for doc in self._user(user_id).collection('referral_shards').stream():
+            total += doc.to_dict().get('points', 0)
+        return total
+
+    async def reset_daily_counts(self, day):
+        # শুধু ওই দিনের ইউজার; আরও পুরনোরা আগের দিনের জবেই শূন্য হয়েছে, তাই প্রতিদিন পুরো ইউজারবেস লেখা হয় না
+        query = (
+            self.client.collection('users')
+            .where('quota_day', '==', day)
+            .order_by('__name__')
+            .limit(RESET_BATCH_SIZE)
+        )
+        last_doc = None
+        while True:
+            page = query if last_doc is None else query.start_after(last_doc)
+            docs = [doc async for doc in page.stream()]
+            if not docs:
+                return
+            batch = self.client.batch()
+            written = 0
+            for doc in docs:
+                if doc.to_dict().get('daily_message_count'):
+                    batch.set(doc.reference, {'daily_message_count': 0}, merge=True)
+                    written += 1
+            if written:
+                await batch.commit()
+            yield written
+            last_doc = docs[-1]
+
+    async def close(self):
+        pass
+
+
+class SQLiteStorage:
+    # প্রোফাইল JSON হিসেবে থাকে, merge হয় json_patch দিয়ে। একই SQL স্ট্রিং বারবার ব্যবহার হয় বলে
+    # sqlite3 এর স্টেটমেন্ট ক্যাশ থেকে প্রস্তুত স্টেটমেন্টই চলে; ProfileCache এর প্রতিটি ফ্লাশ একটি কমিট।
+    UPSERT_USER = (
+        'INSERT INTO users (user_id, data) VALUES (?, ?) '
+        'ON CONFLICT(user_id) DO UPDATE SET data = json_patch(users.data, excluded.data)'
+    )
+    SELECT_USER = 'SELECT data FROM users WHERE user_id = ?'
+    ADD_CREDITS = (
+        'INSERT INTO referral_credits (user_id, points) VALUES (?, ?) '
+        'ON CONFLICT(user_id) DO UPDATE SET points = referral_credits.points + excluded.points'
+    )
+    SELECT_CREDITS = 'SELECT points FROM referral_credits WHERE user_id = ?'
+    RESET_DAILY_COUNTS = (
+        "UPDATE users SET data = json_set(data, '$.daily_message_count', 0) "
+        "WHERE user_id IN (SELECT user_id FROM users WHERE json_extract(data, '$.quota_day') = ? "
+        "AND json_extract(data, '$.daily_message_count') > 0 LIMIT ?)"
+    )
+
+    def __init__(self, path):
+        # ওয়ার্ম-আপ থ্রেডে খোলা হলেও পরে ইভেন্ট লুপ থেকে ব্যবহার হয়
+        self.db = sqlite3.connect(path, cached_statements=64, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL)')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS referral_credits (user_id INTEGER PRIMARY KEY, points INTEGER NOT NULL)'
+        )
+        self.db.commit()
+
+    async def get_user(self, user_id):
+        row = self.db.execute(self.SELECT_USER, (user_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    async def write_users(self, dirty):
+        with self.db:
+            self.db.executemany(self.UPSERT_USER, [
+                (user_id, json.dumps(fields, ensure_ascii=False)) for user_id, fields in dirty.items()
+            ])
+
+    async def write_referral(self, user_id, fields, referrer_id, points):
+        with self.db:
+            self.db.execute(self.UPSERT_USER, (user_id, json.dumps(fields, ensure_ascii=False)))
+            self.db.execute(self.ADD_CREDITS, (referrer_id, points))
+
+    async def get_referral_credits(self, user_id):
+        row = self.db.execute(self.SELECT_CREDITS, (user_id,)).fetchone()
+        return row[0] if row else 0
+
+    async def reset_daily_counts(self, day):
+        while True:
+            with self.db:
+                changed = self.db.execute(self.RESET_DAILY_COUNTS, (day, RESET_BATCH_SIZE)).rowcount
+            if not changed:
+                return
+            yield changed
+            await asyncio.sleep(0) # পাতার মাঝে অন্য আপডেটগুলোকে চলতে দেওয়া
+
+    async def close(self):
+        self.db.close()
+
+
+class MemoryStorage:
+    def __init__(self):
+        self.users = {}
+        self.referral_credits = {}
+
+    async def get_user(self, user_id):
+        data = self.users.get(user_id)
+        if data is None:
+            return None
+        return dict(data)
+
+    async def write_users(self, dirty):
+        for user_id, fields in dirty.items():
+            self.users.setdefault(user_id, {}).update(fields)
+
+    async def write_referral(self, user_id, fields, referrer_id, points):
+        self.users.setdefault(user_id, {}).update(fields)
+        self.referral_credits[referrer_id] = self.referral_credits.get(referrer_id, 0) + points
+
+    async def get_referral_credits(self, user_id):
+        return self.referral_credits.get(user_id, 0)
+
+    async def reset_daily_counts(self, day):
+        stale = [
+            user_id for user_id, data in self.users.items()
+            if data.get('quota_day') == day and data.get('daily_message_count')
+        ]
+        for start in range(0, len(stale), RESET_BATCH_SIZE):
+            page = stale[start:start + RESET_BATCH_SIZE]
+            for user_id in page:
+                self.users[user_id]['daily_message_count'] = 0
+            yield len(page)
+
+    async def close(self):
+        pass
+
+
+def create_storage(backend):
+    if backend == 'sqlite':
+        return SQLiteStorage(SQLITE_PATH)
+    if backend == 'memory':
+        return MemoryStorage()
+    if backend != 'firestore':
+        raise ValueError(f"unknown STORAGE_BACKEND '{backend}'")
+    return FirestoreStorage(init_firestore())
+
+
+class InstrumentedStorage:
+    # ব্যাকএন্ডের প্রতিটি async মেথডের সময় ও এরর মাপা হয়
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+
+    def __getattr__(self, attr):
+        method = getattr(self.backend, attr)
+        if not asyncio.iscoroutinefunction(method):
+            return method
+
+        async def timed(*args, **kwargs):
+            with metrics.timer('storage_request', backend=self.name, op=attr):
+                return await method(*args, **kwargs)
+        return timed
+
+
+_storage = None
+
+
+def get_storage():
+    # প্রথম ব্যবহারে STORAGE_BACKEND অনুযায়ী তৈরি হয়
+    global _storage
+    if _storage is None:
+        started = time.perf_counter()
+        _storage = InstrumentedStorage(create_storage(STORAGE_BACKEND), STORAGE_BACKEND)
+        record_startup('init', f"{STORAGE_BACKEND} storage", started)
+    return _storage
+
+
+async def close_storage():
+    global _storage
+    if _storage is not None:
+        await _storage.close()
+        _storage = None
+
+
+profile_cache = ProfileCache(
+    lambda user_id: get_storage().get_user(user_id),
+    lambda dirty: get_storage().write_users(dirty),
+    PROFILE_CACHE_TTL, PROFILE_CACHE_SIZE, PROFILE_FLUSH_INTERVAL
+)
+
+# --- ইউটিলিটি ফাংশন ---
+
+async def get_user_data(user_id):
+    return await profile_cache.get(user_id)
+
+async def update_user_data(user_id, **kwargs):
+    profile_cache.update(user_id, kwargs)
+
+async def create_user_if_not_exists(user_id, telegram_name):
+    user_data = await get_user_data(user_id)
+    if not user_data:
+        initial_data = {
+            'telegram_name': telegram_name,
+            'language': DEFAULT_LANGUAGE,
+            'plan_type': 'free',
+            'daily_message_count': 0,
+            'quota_day': quota_day_key(),
+            'referral_code': f"REF{user_id}", # ইনিশিয়াল রেফারেল কোড
+            'referred_by_id': None,
+            'referral_points': 0
+        }
+        await update_user_data(user_id, **initial_data)
+
+# --- দৈনিক মেসেজ কোটা ---
+# daily_message_count শুধু quota_day তারিখের জন্য বৈধ; দিন বদলালে আলাদা করে রিসেট লিখতে হয় না,
+# পরের রিজার্ভেশনের লেখাতেই নতুন দিন আর নতুন গণনা একসাথে চলে যায়।
+# প্রোফাইল লোড হওয়ার পর চেক আর বাড়ানোর মাঝে কোনো await নেই, তাই একই ইউজারের একসাথে আসা
+# মেসেজগুলো প্রসেসের ভেতরে একটির পর একটি গণনা হয় এবং কোনো বাড়তি রাউন্ড ট্রিপ লাগে না।
+
+def quota_day_key():
+    return datetime.now().strftime('%Y-%m-%d')
+
+
+class QuotaEngine:
+    def __init__(self, cache):
+        self._cache = cache
+        self.reserved = 0
+        self.refunded = 0
+        self.rejected = 0
+
+    def used_today(self, user_data):
+        # পুরনো ডকুমেন্টে quota_day না থাকলে last_message_date ব্যবহার করা
+        day = user_data.get('quota_day', user_data.get('last_message_date'))
+        if day != quota_day_key():
+            return 0
+        return user_data.get('daily_message_count', 0)
+
+    def limit_for(self, user_data):
+        return FREE_MESSAGE_LIMIT if user_data.get('plan_type', 'free') == 'free' else PREMIUM_MESSAGE_LIMIT
+
+    async def reserve(self, user_id):
+        user_data = await self._cache.get(user_id)
+        used = self.used_today(user_data)
+        if used >= self.limit_for(user_data):
+            self.rejected += 1
+            return None
+        day = quota_day_key()
+        self._cache.update(user_id, {'daily_message_count': used + 1, 'quota_day': day})
+        self.reserved += 1
+        return day
+
+    async def refund(self, user_id, day):
+        user_data = await self._cache.get(user_id)
+        # দিন বদলে গেলে গণনা এমনিতেই শূন্য থেকে শুরু হয়েছে
+        if user_data.get('quota_day') != day:
+            return
+        used = user_data.get('daily_message_count', 0)
+        if used > 0:
+            self._cache.update(user_id, {'daily_message_count': used - 1})
+            self.refunded += 1
+
+    def stats(self):
+        return {
+            'reserved': self.reserved,
+            'refunded': self.refunded,
+            'rejected': self.rejected,
+        }
+
+
+quota = QuotaEngine(profile_cache)
+
+# --- চ্যানেল মেম্বারশিপ ক্যাশ ---
+# প্রতিটি মেসেজে get_chat_member কল করলে বট API রেট লিমিটে পড়ে। সদস্যদের ফলাফল অনেকক্ষণ,
+# আর যারা সদস্য নয় তাদের ফলাফল অল্প সময় রাখা হয় যাতে যোগ দেওয়ার পর দ্রুত চ্যাট শুরু করা যায়।
+# বট চ্যানেলের অ্যাডমিন হলে chat_member আপডেট এসে ক্যাশ সাথে সাথে বদলে দেয়।
+
+MEMBER_STATUSES = ("member", "administrator", "creator")
+
+
+class MembershipCache:
+    def __init__(self, channel_id, member_ttl, non_member_ttl, max_size):
+        self.channel_id = channel_id
+        self.member_ttl = member_ttl
+        self.non_member_ttl = non_member_ttl
+        self.max_size = max_size
+        self._entries = OrderedDict() # user_id -> (expires_at, is_member)
+        self._checking = {} # user_id -> চলমান API কল
+
+        # কাউন্টার
+        self.hits = 0
+        self.misses = 0
+        self.api_calls = 0
+        self.api_errors = 0
+        self.invalidations = 0
+
+    async def is_member(self, bot, user_id):
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        task = self._checking.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._check(bot, user_id))
+            self._checking[user_id] = task
+        return await asyncio.shield(task)
+
+    async def _check(self, bot, user_id):
+        try:
+            self.api_calls += 1
+            chat_member = await bot.get_chat_member(self.channel_id, user_id)
+            self.set_status(user_id, chat_member.status)
+            return chat_member.status in MEMBER_STATUSES
+        except Exception:
+            # ত্রুটির ফলাফল ক্যাশ করা হয় না
+            self.api_errors += 1
+            raise
+        finally:
+            del self._checking[user_id]
+
+    def set_status(self, user_id, status):
+        is_member = status in MEMBER_STATUSES
+        ttl = self.member_ttl if is_member else self.non_member_ttl
+        self._entries[user_id] = (time.monotonic() + ttl, is_member)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def sweep(self):
+        now = time.monotonic()
+        expired = [user_id for user_id, (expires_at, _) in self._entries.items() if expires_at <= now]
+        for user_id in expired:
+            del self._entries[user_id]
+        return len(expired)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 3) if lookups else 0,
+            'api_calls': self.api_calls,
+            'api_calls_saved': lookups - self.api_calls,
+            'api_errors': self.api_errors,
+            'invalidations': self.invalidations,
+        }
+
+
+membership_cache = MembershipCache(
+    TELEGRAM_CHANNEL_ID, MEMBERSHIP_MEMBER_TTL, MEMBERSHIP_NON_MEMBER_TTL, MEMBERSHIP_CACHE_SIZE
 )
 
-# গুগল জেমিনি এপিআই লাইব্রেরি
-import google.generativeai as genai
+# --- কথোপকথনের মেমোরি ---
+# প্রতিটি ইউজারের সাম্প্রতিক টার্নগুলো একটি ছোট রিং বাফারে রাখা হয় এবং জেমিনিকে হিস্টোরি হিসেবে
+# পাঠানো হয়। টোকেন বাজেট ছাড়িয়ে গেলে পুরনো টার্নগুলো সরিয়ে পরে ব্যাকগ্রাউন্ডে একটি সারাংশে
+# মিলিয়ে দেওয়া হয়। সব সেশনের মোট আকার CONVERSATION_MEMORY_LIMIT এর মধ্যে রাখতে অলস সেশনগুলো
+# LRU ক্রমে সরানো হয় (CONVERSATION_DB দেওয়া থাকলে সরানোর আগে SQLite এ রেখে দেওয়া হয়)।
 
-# Firebase Admin SDK
-import firebase_admin
-from firebase_admin import credentials, firestore
+def estimate_tokens(text):
+    # মোটামুটি হিসাব: গড়ে ৪ অক্ষরে ১ টোকেন
+    return len(text) // 4 + 1
 
-# --- আপনার প্রয়োজনীয় তথ্য (এনভায়রনমেন্ট ভেরিয়েবল থেকে নেওয়া হবে) ---
-TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
-TELEGRAM_CHANNEL_ID = int(os.environ.get("TELEGRAM_CHANNEL_ID", "-1002161374444")) # আপনার চ্যানেলের আইডি
-TELEGRAM_CHANNEL_LINK = os.environ.get("TELEGRAM_CHANNEL_LINK", "https://t.me/pixigpt") # আপনার চ্যানেলের সম্পূর্ণ লিঙ্ক
 
-# কোটা সেটিংস
-FREE_MESSAGE_LIMIT = 15 # প্রতিদিন ফ্রি প্ল্যানে ১৫টি মেসেজ
-PREMIUM_MESSAGE_LIMIT = 999999999 # প্রিমিয়াম প্ল্যানে আনলিমিটেড মেসেজ
+class ConversationSession:
+    __slots__ = ('turns', 'summary', 'pending', 'tokens', 'size', 'last_used', 'summarizing')
 
-# --- API কনফিগারেশন ---
-GOOGLE_GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY") 
+    def __init__(self, turns=(), summary=''):
+        self.turns = deque() # (role, text, tokens)
+        self.summary = summary
+        self.pending = [] # বাজেট থেকে সরানো, এখনো সারাংশে না মেলানো টার্ন
+        self.tokens = estimate_tokens(summary) if summary else 0
+        self.size = len(summary.encode())
+        self.last_used = time.monotonic()
+        self.summarizing = False
+        for role, text in turns:
+            self.append(role, text)
 
-# নিশ্চিত করুন প্রয়োজনীয় পরিবেশ ভেরিয়েবল সেট করা আছে
-if not TELEGRAM_BOT_TOKEN:
-    print("Error: TELEGRAM_BOT_TOKEN environment variable not set.")
-    exit(1)
-if not GOOGLE_GEMINI_API_KEY:
-    print("Error: GEMINI_API_KEY environment variable not set.")
-    exit(1)
+    def append(self, role, text):
+        tokens = estimate_tokens(text)
+        self.turns.append((role, text, tokens))
+        self.tokens += tokens
+        self.size += len(text.encode())
 
-genai.configure(api_key=GOOGLE_GEMINI_API_KEY)
-gemini_model = genai.GenerativeModel('gemini-pro')
+    def pop_oldest(self):
+        role, text, tokens = self.turns.popleft()
+        self.tokens -= tokens
+        self.size -= len(text.encode())
+        self.pending.append((role, text))
 
-# --- Firebase সেটআপ ---
-FIREBASE_SERVICE_ACCOUNT_KEY = os.environ.get("FIREBASE_SERVICE_ACCOUNT_KEY")
+    def set_summary(self, summary):
+        if self.summary:
+            self.tokens -= estimate_tokens(self.summary)
+        self.size += len(summary.encode()) - len(self.summary.encode())
+        self.summary = summary
+        self.tokens += estimate_tokens(summary) if summary else 0
 
-if not FIREBASE_SERVICE_ACCOUNT_KEY:
-    print("Error: FIREBASE_SERVICE_ACCOUNT_KEY environment variable not set.")
-    print("Please add your Firebase service account JSON content as an environment variable.")
-    exit(1)
 
-try:
-    # Service Account Key একটি স্ট্রিং হিসেবে আসবে, এটিকে JSON অবজেক্টে রূপান্তর করতে হবে
-    import json
-    cred_json = json.loads(FIREBASE_SERVICE_ACCOUNT_KEY)
-    cred = credentials.Certificate(cred_json)
-    firebase_admin.initialize_app(cred)
-    db = firestore.client()
-    print("Firebase initialized successfully.")
-except Exception as e:
-    print(f"Error initializing Firebase: {e}")
-    exit(1)
+class ConversationStore:
+    def __init__(self, token_budget, max_turns, memory_limit, idle_ttl, db_path=None, summarizer=None):
+        self.token_budget = token_budget
+        self.max_turns = max_turns
+        self.memory_limit = memory_limit
+        self.idle_ttl = idle_ttl
+        self.summarizer = summarizer
+        self._sessions = OrderedDict() # user_id -> ConversationSession
+        self._summary_tasks = set() # রেফারেন্স না রাখলে চলমান টাস্ক গার্বেজ কালেক্টেড হতে পারে
+        self.total_size = 0
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS conversations ('
+                'user_id INTEGER PRIMARY KEY, summary TEXT NOT NULL, turns TEXT NOT NULL, updated_at REAL NOT NULL)'
+            )
+            self._db.commit()
 
-# --- ইউটিলিটি ফাংশন (Firebase ব্যবহার করে) ---
+        # কাউন্টার
+        self.evictions = 0
+        self.summaries = 0
+        self.summary_errors = 0
+        self.restored = 0
 
-# SQLite ফাংশনগুলো রাখা হয়েছে, তবে Firebase এর সমতুল্য ফাংশন ব্যবহার হবে
-# ডেটাবেজ স্ট্রাকচার: users/user_id -> {telegram_name, language, plan_type, daily_message_count, last_message_date, referral_code, referred_by_id, referral_points}
+    def _session(self, user_id, create=True):
+        session = self._sessions.get(user_id)
+        if session is None:
+            session = self._restore(user_id)
+            if session is None:
+                if not create:
+                    return None
+                session = ConversationSession()
+            self._sessions[user_id] = session
+            self.total_size += session.size
+        self._sessions.move_to_end(user_id)
+        session.last_used = time.monotonic()
+        return session
 
-async def get_user_data(user_id):
-    doc_ref = db.collection('users').document(str(user_id))
-    doc = await doc_ref.get() # await ব্যবহার করতে হলে কোডের বাকি অংশ async হতে হবে
-    if doc.exists:
-        return doc.to_dict()
-    return None
+    def _restore(self, user_id):
+        if self._db is None:
+            return None
+        row = self._db.execute('SELECT summary, turns FROM conversations WHERE user_id = ?', (user_id,)).fetchone()
+        if row is None:
+            return None
+        self.restored += 1
+        return ConversationSession(json.loads(row[1]), row[0])
 
-async def update_user_data(user_id, **kwargs):
-    doc_ref = db.collection('users').document(str(user_id))
-    await doc_ref.set(kwargs, merge=True)
+    def _persist(self, user_id, session):
+        if self._db is None:
+            return
+        turns = [(role, text) for role, text, _ in session.turns]
+        self._db.execute(
+            'INSERT OR REPLACE INTO conversations (user_id, summary, turns, updated_at) VALUES (?, ?, ?, ?)',
+            (user_id, session.summary, json.dumps(turns, ensure_ascii=False), time.time())
+        )
 
-async def create_user_if_not_exists(user_id, telegram_name):
-    user_data = await get_user_data(user_id)
-    if not user_data:
-        initial_data = {
-            'telegram_name': telegram_name,
-            'language': 'en',
-            'plan_type': 'free',
-            'daily_message_count': 0,
-            'last_message_date': datetime.now().strftime('%Y-%m-%d'),
-            'referral_code': f"REF{user_id}", # ইনিশিয়াল রেফারেল কোড
-            'referred_by_id': None,
-            'referral_points': 0
+    def has_history(self, user_id):
+        session = self._session(user_id, create=False)
+        return session is not None and bool(session.turns or session.summary)
+
+    def build_contents(self, user_id, user_message):
+        # জেমিনির জন্য হিস্টোরি + নতুন মেসেজ
+        session = self._session(user_id)
+        contents = []
+        if session.summary:
+            contents.append({'role': 'user', 'parts': [f"Summary of our earlier conversation: {session.summary}"]})
+            contents.append({'role': 'model', 'parts': ["Understood."]})
+        for role, text, _ in session.turns:
+            contents.append({'role': role, 'parts': [text]})
+        contents.append({'role': 'user', 'parts': [user_message]})
+        return contents
+
+    def add_exchange(self, user_id, user_message, model_message):
+        session = self._session(user_id)
+        before = session.size
+        session.append('user', user_message)
+        session.append('model', model_message)
+        # জোড়ায় জোড়ায় সরানো যাতে হিস্টোরি সবসময় user দিয়ে শুরু হয়
+        while len(session.turns) > 2 and (session.tokens > self.token_budget or len(session.turns) > self.max_turns):
+            session.pop_oldest()
+            session.pop_oldest()
+        self.total_size += session.size - before
+
+        # প্রতি মেসেজে নয়, যথেষ্ট পুরনো টার্ন জমলে তবেই একবার সারাংশ করা হয়
+        if session.pending and not session.summarizing:
+            if self.summarizer is None:
+                session.pending.clear()
+            elif sum(estimate_tokens(text) for _, text in session.pending) >= self.token_budget // 4:
+                session.summarizing = True
+                task = asyncio.ensure_future(self._summarize(user_id, session))
+                self._summary_tasks.add(task)
+                task.add_done_callback(self._summary_tasks.discard)
+        self._evict()
+
+    async def _summarize(self, user_id, session):
+        pending = session.pending
+        session.pending = []
+        try:
+            summary = await self.summarizer(session.summary, pending)
+            before = session.size
+            session.set_summary(summary)
+            if self._sessions.get(user_id) is session:
+                self.total_size += session.size - before
+            self.summaries += 1
+        except Exception as e:
+            # সারাংশ না হলে পুরনো টার্নগুলো বাদ পড়ে যায়, আগের সারাংশ থেকে যায়
+            self.summary_errors += 1
+            print(f"Error summarizing conversation for user {user_id}: {e!r}")
+        finally:
+            session.summarizing = False
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if self.total_size <= self.memory_limit and now - session.last_used < self.idle_ttl:
+                break
+            self._drop(user_id)
+        if self._db is not None:
+            self._db.commit()
+
+    def sweep(self):
+        # নতুন মেসেজ না এলেও অলস সেশনগুলো মেমোরি থেকে সরানো (ডিস্ক থাকলে সেখানে রেখে)
+        before = self.evictions
+        self._evict()
+        return self.evictions - before
+
+    def _drop(self, user_id):
+        session = self._sessions.pop(user_id)
+        self.total_size -= session.size
+        self._persist(user_id, session)
+        self.evictions += 1
+
+    async def close(self):
+        # চলমান সারাংশের জন্য অপেক্ষা না করে বাতিল করা (বন্ধের সময় সীমিত); আগের সারাংশ থেকে যায়
+        for task in list(self._summary_tasks):
+            task.cancel()
+        await asyncio.gather(*self._summary_tasks, return_exceptions=True)
+        if self._db is None:
+            return
+        for user_id, session in self._sessions.items():
+            self._persist(user_id, session)
+        self._db.commit()
+
+    def stats(self):
+        sessions = len(self._sessions)
+        return {
+            'sessions': sessions,
+            'memory_bytes': self.total_size,
+            'avg_bytes_per_session': self.total_size // sessions if sessions else 0,
+            'evictions': self.evictions,
+            'restored': self.restored,
+            'summaries': self.summaries,
+            'summarizing': len(self._summary_tasks),
+            'summary_errors': self.summary_errors,
         }
-        await db.collection('users').document(str(user_id)).set(initial_data)
 
-async def reset_daily_counts_firebase():
-    # Firestore এ সমস্ত ব্যবহারকারীর জন্য দৈনিক কাউন্টার রিসেট করা
-    # এটি প্রতিদিন মধ্যরাতে একবার কল করতে হবে
-    today_str = datetime.now().strftime('%Y-%m-%d')
-    users_ref = db.collection('users')
-    
-    # Firestore query for users whose last_message_date is not today
-    # Note: Firestore does not support 'not equal to' queries directly on indexed fields.
-    # A more robust solution for large databases involves periodically running a Cloud Function
-    # to reset counts, or handling it on per-user basis upon their first message of the day.
-    # For now, we'll keep it simple for illustration.
-    
-    # Simpler approach: update only when user sends message on new day
-    # This function would mainly be for a general reset if needed for admin purposes
-    # For this bot, the reset logic is handled in handle_message for each user.
-    print("Firebase daily counts will be reset per user activity or via Cloud Function.")
+
+async def summarize_conversation(previous_summary, turns):
+    transcript = "\n".join(f"{role}: {text}" for role, text in turns)
+    prompt = (
+        f"Summarize this conversation in at most {CONVERSATION_SUMMARY_WORDS} words, keeping facts, names "
+        "and open questions the assistant will need later. Reply with the summary only.\n\n"
+    )
+    if previous_summary:
+        prompt += f"Earlier summary: {previous_summary}\n\n"
+    prompt += transcript
+    return (await inference.generate(prompt, plan=SUMMARY_PLAN)).strip()
+
+
+conversations = ConversationStore(
+    CONVERSATION_TOKEN_BUDGET, CONVERSATION_MAX_TURNS, CONVERSATION_MEMORY_LIMIT, CONVERSATION_IDLE_TTL,
+    db_path=CONVERSATION_DB or None,
+    summarizer=summarize_conversation if CONVERSATION_SUMMARY_WORDS > 0 else None
+)
+
+# --- রেসপন্স ক্যাশ ---
+# অনেক ফ্রি ইউজার একই প্রশ্ন পাঠায় ("hi", "who are you")। নরমালাইজ করা প্রশ্ন + ভাষা + মডেল
+# দিয়ে উত্তর ক্যাশ করা হয়: মেমোরিতে LRU/TTL, আর RESPONSE_CACHE_DB দিলে SQLite এ দ্বিতীয় স্তর।
+# একই প্রশ্ন একসাথে এলে একটিই জেমিনি কল হয়, বাকিরা সেটার উত্তরের জন্য অপেক্ষা করে।
+# হিস্টোরি থাকলে উত্তর প্রসঙ্গের উপর নির্ভর করে, তাই তখন ক্যাশ ব্যবহার করা হয় না।
+
+def normalize_prompt(text):
+    text = unicodedata.normalize('NFKC', text).casefold()
+    text = ' '.join(text.split())
+    return text.strip(' .,!?।;:~')
+
+
+class ResponseCache:
+    def __init__(self, max_size, ttl, db_path=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict() # key -> (expires_at, response)
+        self._in_flight = {} # key -> Future
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+            self._db.commit()
+
+        # কাউন্টার
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.stores = 0
+        self.bypassed = 0
+
+    def key(self, prompt, language, model_name):
+        raw = f"{model_name}\0{language}\0{normalize_prompt(prompt)}"
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry[1]
+            del self._entries[key]
+
+        if self._db is not None:
+            row = self._db.execute('SELECT response, expires_at FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is not None and row[1] > time.time():
+                self._remember(key, row[0], row[1])
+                self.disk_hits += 1
+                return row[0]
+
+        self.misses += 1
+        return None
+
+    def join(self, key):
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.shared += 1
+        return future
+
+    def lead(self, key):
+        self._in_flight[key] = asyncio.get_running_loop().create_future()
+
+    def finish(self, key, response, store=True):
+        # ব্যর্থ হলে অপেক্ষমাণরা None পায় এবং নিজেরাই জেমিনিকে কল করে
+        future = self._in_flight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(response)
+        if not response or not store:
+            return
+
+        expires_at = time.time() + self.ttl
+        self._remember(key, response, expires_at)
+        self.stores += 1
+        if self._db is not None:
+            self._db.execute(
+                'INSERT OR REPLACE INTO responses (key, response, expires_at) VALUES (?, ?, ?)',
+                (key, response, expires_at)
+            )
+            self._db.commit()
+
+    def sweep(self):
+        # মেয়াদোত্তীর্ণ উত্তর মেমোরি ও ডিস্ক থেকে মুছে ফেলা (রক্ষণাবেক্ষণ জব থেকে চলে)
+        now = time.time()
+        expired = [key for key, (expires_at, _) in self._entries.items() if expires_at <= now]
+        for key in expired:
+            del self._entries[key]
+        removed = len(expired)
+        if self._db is not None:
+            with self._db:
+                removed += self._db.execute('DELETE FROM responses WHERE expires_at <= ?', (now,)).rowcount
+        return removed
+
+    def _remember(self, key, response, expires_at):
+        self._entries[key] = (expires_at, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        return {
+            'size': len(self._entries),
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_ratio': round(hits / lookups, 3) if lookups else 0,
+            'shared_in_flight': self.shared,
+            'stores': self.stores,
+            'bypassed': self.bypassed,
+        }
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, db_path=RESPONSE_CACHE_DB or None)
+
+# --- রেফারেল ---
+# রেফারেল কোড সবসময় REF{user_id}, তাই কোড থেকেই রেফারারের আইডি পাওয়া যায়, কোনো কোয়েরি লাগে না।
+# রেফারড ইউজারের referred_by_id আর রেফারারের পয়েন্ট একই ব্যাচে লেখা হয়। ভাইরাল লিঙ্কে একসাথে
+# অনেক /start এলে একটি ডকুমেন্টে চাপ না পড়ার জন্য পয়েন্টগুলো users/{id}/referral_shards/{n}
+# এর কয়েকটি শার্ডে Increment দিয়ে যোগ হয় (SQLite/মেমোরিতে আলাদা টেবিলে);
+# মোট পয়েন্ট = referral_points + স্টোরেজের রেফারেল ক্রেডিট (প্রোফাইল ক্যাশে TTL পর্যন্ত রাখা হয়)।
+
+def decode_referral_code(code):
+    if code.startswith('REF') and code[3:].isdigit():
+        return int(code[3:])
+    return None
+
+async def apply_referral(user_id, referrer_code):
+    referrer_id = decode_referral_code(referrer_code)
+    if referrer_id is None or referrer_id == user_id:
+        return False
+    if not await get_user_data(referrer_id):
+        return False
+    user_data = await get_user_data(user_id)
+    if not user_data or user_data.get('referred_by_id') is not None:
+        return False
+
+    # চেক আর ক্যাশে বসানোর মাঝে কোনো await নেই, তাই একই ইউজারের দুটি /start দুবার পয়েন্ট দেবে না
+    try:
+        await profile_cache.write_now(
+            user_id, {'referred_by_id': referrer_id},
+            lambda fields: get_storage().write_referral(user_id, fields, referrer_id, REFERRAL_POINTS)
+        )
+    except Exception as e:
+        print(f"Error applying referral {referrer_code} for user {user_id}: {e!r}")
+        return False
+    profile_cache.add_referral_credits(referrer_id, REFERRAL_POINTS)
+    return True
+
+async def get_referral_points(user_id, user_data):
+    return user_data.get('referral_points', 0) + await profile_cache.referral_credits(
+        user_id, get_storage().get_referral_credits
+    )
+
+# --- লোকালাইজেশন ক্যাটালগ ---
+# সব ভাষার টেক্সট locales/<ভাষা>.json ফাইলে থাকে এবং স্টার্টআপে একবারই লোড হয়। টেমপ্লেটগুলো আগেই
+# পার্স করে রাখা হয় আর প্রতিটি ভাষার কিবোর্ড আগেই তৈরি থাকে, ফলে প্রতি আপডেটে শুধু নির্বাচিত
+# ভাষার একটি টেক্সট ফরম্যাট হয়। নতুন ভাষা যোগ করতে শুধু একটি JSON ফাইল যোগ করলেই হবে।
+
+class MessageTemplate:
+    __slots__ = ('text', 'parts')
+
+    def __init__(self, text):
+        parsed = list(string.Formatter().parse(text))
+        self.text = ''.join(literal for literal, _, _, _ in parsed)
+        self.parts = None
+        if any(field is not None for _, field, _, _ in parsed):
+            self.parts = [(literal, field, spec) for literal, field, spec, _ in parsed]
+
+    def render(self, values):
+        if self.parts is None:
+            return self.text
+        out = []
+        for literal, field, spec in self.parts:
+            out.append(literal)
+            if field is not None:
+                out.append(format(values[field], spec))
+        return ''.join(out)
+
+
+class LocaleCatalog:
+    def __init__(self, directory, default_language):
+        self.default_language = default_language
+        self._templates = {} # ভাষা -> কী -> MessageTemplate
+        self._command_texts = {} # ভাষা -> কমান্ড -> বর্ণনা
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith('.json'):
+                continue
+            with open(os.path.join(directory, filename), encoding='utf-8') as f:
+                data = json.load(f)
+            language = filename[:-len('.json')]
+            self._command_texts[language] = data.pop('commands', {})
+            self._templates[language] = {key: MessageTemplate(text) for key, text in data.items()}
+
+        if default_language not in self._templates:
+            raise RuntimeError(f"Default language file {default_language}.json not found in {directory}")
+        # অনুবাদ না থাকা কী ডিফল্ট ভাষা থেকে নেওয়া
+        for language, templates in self._templates.items():
+            for key, template in self._templates[default_language].items():
+                templates.setdefault(key, template)
+            for name, description in self._command_texts[default_language].items():
+                self._command_texts[language].setdefault(name, description)
+
+        # ডিফল্ট ভাষা আগে, বাকিগুলো ফাইলের নাম অনুযায়ী
+        self.languages = [default_language] + [code for code in self._templates if code != default_language]
+
+        language_keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton(self.text(code, 'language_name'), callback_data=f'lang_{code}')]
+            for code in self.languages
+        ])
+        self._keyboards = {}
+        for code in self.languages:
+            self._keyboards[code, 'languages'] = language_keyboard
+            self._keyboards[code, 'join_channel'] = InlineKeyboardMarkup([
+                [InlineKeyboardButton(self.text(code, 'join_channel_button'), url=TELEGRAM_CHANNEL_LINK)]
+            ])
+            self._keyboards[code, 'main_menu'] = InlineKeyboardMarkup([
+                [InlineKeyboardButton(self.text(code, 'chat_ai_button'), callback_data='chat_ai')]
+            ])
+
+    def resolve(self, language):
+        return language if language in self._templates else self.default_language
+
+    def text(self, language, key, **values):
+        templates = self._templates.get(language) or self._templates[self.default_language]
+        return templates[key].render(values)
+
+    def keyboard(self, language, name):
+        return self._keyboards.get((language, name)) or self._keyboards[self.default_language, name]
+
+    def commands(self, language):
+        return [
+            BotCommand(name, description)
+            for name, description in self._command_texts[self.resolve(language)].items()
+        ]
+
+
+catalog = LocaleCatalog(LOCALES_DIR, DEFAULT_LANGUAGE)
+
+
+# --- রক্ষণাবেক্ষণ জব ---
+# ব্যবহারকারীর পথের বাইরে python-telegram-bot এর JobQueue এ চলা কাজগুলো:
+#   reset_daily_counts - প্রতিদিন একবার গতকালের quota_day এর ইউজারদের কাউন্টার ৫০০ করে এক ব্যাচে শূন্য করা
+#   sweep_sessions     - অলস কথোপকথন ও মেয়াদ শেষ হওয়া ক্যাশ এন্ট্রি নিয়মিত সরানো
+#   register_commands  - স্টার্টআপে একবার প্রতিটি ভাষার কমান্ড তালিকা টেলিগ্রামে পাঠানো
+# প্রতিটি জবের সময়, কতগুলো আইটেম হলো এবং ব্যর্থতা মেট্রিক্সে যায়।
+
+class MaintenanceJobs:
+    def __init__(self):
+        self.runs = {}
+        self.failures = {}
+        self.last_items = {}
+        self.last_duration = {}
+        self.last_finished = {}
+        self.running = set()
+
+    def job(self, name):
+        def decorator(callback):
+            @functools.wraps(callback)
+            async def wrapper(context):
+                if name in self.running:
+                    print(f"Maintenance job {name} is still running, skipping this run")
+                    return
+                self.running.add(name)
+                started = time.perf_counter()
+                try:
+                    with metrics.timer('job', job=name):
+                        self.last_items[name] = await callback(context)
+                    self.runs[name] = self.runs.get(name, 0) + 1
+                except Exception as e:
+                    self.failures[name] = self.failures.get(name, 0) + 1
+                    print(f"Maintenance job {name} failed: {e!r}")
+                finally:
+                    self.running.discard(name)
+                    self.last_duration[name] = time.perf_counter() - started
+                    self.last_finished[name] = time.time()
+            return wrapper
+        return decorator
+
+    def progress(self, name, count):
+        metrics.inc('job_items_total', count, job=name)
+
+    def stats(self):
+        stats = {}
+        for name in sorted(set(self.runs) | set(self.failures)):
+            stats[f"{name}_runs"] = self.runs.get(name, 0)
+            stats[f"{name}_failures"] = self.failures.get(name, 0)
+            stats[f"{name}_last_items"] = self.last_items.get(name) or 0
+            stats[f"{name}_last_duration_ms"] = round(self.last_duration.get(name, 0) * 1000, 1)
+        return stats
+
+
+maintenance = MaintenanceJobs()
+
+
+@maintenance.job('reset_daily_counts')
+async def reset_daily_counts_job(context) -> int:
+    # কোটা গণনা quota_day দিয়েই চলে, তাই এই রিসেট শুধু স্টোরের ডেটা পরিষ্কার রাখে। ইউজার এর মধ্যে
+    # মেসেজ পাঠালে প্রসেসের ভেতরের কোটাই সঠিক থাকে এবং পরের রিজার্ভেশনের লেখায় স্টোরও ঠিক হয়ে যায়।
+    # quota_day বদলানো হয় না, তাই কালকের জবে এরা আর মিলবে না। কোনো দিন জব না চললে সেই দিনের
+    # গণনা স্টোরে থেকে যায়, তবে quota_day পুরনো বলে কোটায় কোনো প্রভাব নেই।
+    day = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+    total = 0
+    async for count in get_storage().reset_daily_counts(day):
+        total += count
+        maintenance.progress('reset_daily_counts', count)
+    print(f"Daily reset: {total} user counters reset for {day}")
+    return total
+
+
+@maintenance.job('sweep_sessions')
+async def sweep_sessions_job(context) -> int:
+    removed = conversations.sweep() + profile_cache.sweep() + membership_cache.sweep() + response_cache.sweep()
+    maintenance.progress('sweep_sessions', removed)
+    return removed
+
+
+@maintenance.job('register_commands')
+async def register_commands_job(context) -> int:
+    # ভাষা বাছাইয়ের সময় নয়, স্টার্টআপে একবার: ডিফল্ট তালিকা আর প্রতিটি ভাষার নিজস্ব তালিকা
+    await context.bot.set_my_commands(catalog.commands(DEFAULT_LANGUAGE))
+    for language in catalog.languages:
+        await context.bot.set_my_commands(catalog.commands(language), language_code=language)
+        maintenance.progress('register_commands', 1)
+    return len(catalog.languages)
+
+
+def schedule_maintenance(application):
+    job_queue = application.job_queue
+    if job_queue is None:
+        print("Warning: JobQueue is not available (install python-telegram-bot[job-queue]), maintenance jobs are disabled.")
+        return
+
+    job_queue.run_repeating(
+        sweep_sessions_job, interval=MAINTENANCE_SWEEP_INTERVAL, first=MAINTENANCE_SWEEP_INTERVAL, name='sweep_sessions'
+    )
+    if WORKER_INDEX:
+        # একাধিক ওয়ার্কার প্রসেসে সবার জন্য একবারের কাজগুলো শুধু প্রথম ওয়ার্কার করে
+        return
+    job_queue.run_once(register_commands_job, when=0, name='register_commands')
+    hour, minute = (int(part) for part in MAINTENANCE_RESET_TIME.split(':'))
+    # quota_day_key সার্ভারের লোকাল তারিখ ব্যবহার করে, তাই রিসেটও লোকাল সময়ে। astimezone() এর
+    # নির্দিষ্ট অফসেট DST বদলালে এক ঘণ্টা সরে যায়; tzlocal (APScheduler এর ডিপেনডেন্সি) আসল জোন দেয়
+    from tzlocal import get_localzone
+    local_tz = get_localzone()
+    job_queue.run_daily(reset_daily_counts_job, time=dt_time(hour, minute, tzinfo=local_tz), name='reset_daily_counts')
+
+
+# --- মেট্রিক্স কালেক্টর ---
+# আগের stats() গুলো /metrics এ gauge হিসেবে দেখা যায়
+metrics.register('inference', inference.stats)
+metrics.register('router', router.metric_stats)
+metrics.register('profile_cache', profile_cache.stats)
+metrics.register('quota', quota.stats)
+metrics.register('membership_cache', membership_cache.stats)
+metrics.register('conversations', conversations.stats)
+metrics.register('response_cache', response_cache.stats)
+metrics.register('outbound', outbox.stats)
+metrics.register('jobs', maintenance.stats)
 
 # --- হ্যান্ডলার ফাংশন ---
 
+@instrument('start')
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     user_name = update.effective_user.first_name or update.effective_user.username or "User"
@@ -116,20 +2479,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     if context.args:
         referrer_code = context.args[0]
-        referrer_doc = await db.collection('users').where('referral_code', '==', referrer_code).get()
-        
-        referrer_id = None
-        for doc in referrer_doc:
-            referrer_id = int(doc.id)
-            break
-        
-        user_data = await get_user_data(user_id) # গেট লেটেস্ট ইউজার ডেটা
-        
-        if referrer_id and user_id != referrer_id and (user_data['referred_by_id'] is None):
-            await update_user_data(user_id, referred_by_id=referrer_id)
-            referrer_current_points = (await get_user_data(referrer_id)).get('referral_points', 0)
-            await update_user_data(referrer_id, referral_points=referrer_current_points + 2)
-            await update.message.reply_text(f"আপনি সফলভাবে `{referrer_code}` দ্বারা রেফার হয়েছেন! এবং আপনার রেফারারকে 2 পয়েন্ট দেওয়া হয়েছে।", parse_mode='Markdown')
+        if await apply_referral(user_id, referrer_code):
+            user_lang = (await get_user_data(user_id)).get('language', DEFAULT_LANGUAGE)
+            await outbox.reply(
+                update.message,
+                catalog.text(user_lang, 'referral_success', referrer_code=referrer_code, points=REFERRAL_POINTS),
+                parse_mode='Markdown'
+            )
 
     await send_welcome_message(update, context)
 
@@ -138,44 +2494,12 @@ async def send_welcome_message(update: Update, context: ContextTypes.DEFAULT_TYP
     user_id = update.effective_user.id
     user_name = update.effective_user.first_name or update.effective_user.username or "User"
     user_data = await get_user_data(user_id) # async call
-    user_lang = user_data.get('language', 'en')
-
-    messages = {
-        'en': (
-            f"🌟 **Welcome to PixiGPT, {user_name}!** 🌟\n\n"
-            "I'm your personal AI assistant, ready to chat and help you with anything you need.\n\n"
-            "To unlock my full potential and start exploring, please join our official Telegram channel:\n"
-            f"👉 {TELEGRAM_CHANNEL_LINK}\n\n"
-            "Once you've joined, just type anything, and we'll get started! Let's create something amazing together. ✨"
-        ),
-        'bn': (
-            f"🌟 **PixiGPT-তে আপনাকে স্বাগতম, {user_name}!** 🌟\n\n"
-            "আমি আপনার ব্যক্তিগত এআই সহকারী, আপনার প্রয়োজন অনুযায়ী চ্যাট করতে এবং সাহায্য করতে প্রস্তুত।\n\n"
-            "আমার সম্পূর্ণ ক্ষমতা আনলক করতে এবং এক্সপ্লোর করা শুরু করতে, অনুগ্রহ করে আমাদের অফিসিয়াল টেলিগ্রাম চ্যানেলে যোগ দিন:\n"
-            f"👉 {TELEGRAM_CHANNEL_LINK}\n\n"
-            "একবার যোগদানের পর, যেকোনো কিছু টাইপ করুন, এবং আমরা শুরু করব! চলুন একসাথে অসাধারণ কিছু তৈরি করি। ✨"
-        ),
-        'es': (
-            f"🌟 **¡Bienvenido a PixiGPT, {user_name}!** 🌟\n\n"
-            "Soy tu asistente personal de IA, lista para chatear y ayudarte con todo lo que necesites.\n\n"
-            "Para desbloquear todo mi potencial y empezar a explorar, por favor únete a nuestro canal oficial de Telegram:\n"
-            f"👉 {TELEGRAM_CHANNEL_LINK}\n\n"
-            "Una vez que te hayas unido, ¡simplemente escribe algo y empezaremos! Creemos algo increíble juntos. ✨"
-        ),
-        'id': (
-            f"🌟 **Selamat datang di PixiGPT, {user_name}!** 🌟\n\n"
-            "Saya asisten AI pribadi Anda, siap untuk mengobrol dan membantu Anda dengan apa pun yang Anda butuhkan.\n\n"
-            "Untuk membuka potensi penuh saya dan mulai menjelajah, silakan bergabung dengan saluran Telegram resmi kami:\n"
-            f"👉 {TELEGRAM_CHANNEL_LINK}\n\n"
-            "Setelah Anda bergabung, cukup ketik apa saja, dan kita akan mulai! Mari ciptakan sesuatu yang luar biasa bersama. ✨"
-        )
-    }
-    
-    keyboard = [[InlineKeyboardButton("Join Channel", url=TELEGRAM_CHANNEL_LINK)]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    user_lang = user_data.get('language', DEFAULT_LANGUAGE)
 
-    await (update.message or update.callback_query).reply_text(
-        messages.get(user_lang, messages['en']), reply_markup=reply_markup, parse_mode='Markdown'
+    await outbox.reply(
+        update.effective_message,
+        catalog.text(user_lang, 'welcome', user_name=user_name, channel_link=TELEGRAM_CHANNEL_LINK),
+        reply_markup=catalog.keyboard(user_lang, 'join_channel'), parse_mode='Markdown'
     )
 
 
@@ -183,8 +2507,7 @@ async def check_channel_membership(update: Update, context: ContextTypes.DEFAULT
     user_id = update.effective_user.id
     
     try:
-        chat_member = await context.bot.get_chat_member(TELEGRAM_CHANNEL_ID, user_id)
-        if chat_member.status in ["member", "administrator", "creator"]:
+        if await membership_cache.is_member(context.bot, user_id):
             return True
         else:
             await send_welcome_message(update, context)
@@ -195,225 +2518,205 @@ async def check_channel_membership(update: Update, context: ContextTypes.DEFAULT
         await send_welcome_message(update, context) 
         return False
 
+@instrument('chat_member')
+async def handle_channel_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # বট চ্যানেলের অ্যাডমিন হলে যোগ দেওয়া/চলে যাওয়ার খবর এখানে আসে
+    member_update = update.chat_member
+    if member_update.chat.id != TELEGRAM_CHANNEL_ID:
+        return
+    membership_cache.set_status(member_update.new_chat_member.user.id, member_update.new_chat_member.status)
+    membership_cache.invalidations += 1
+
+@instrument('language')
 async def language_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_data = await get_user_data(update.effective_user.id)
-    user_lang = user_data.get('language', 'en')
-    
-    keyboard = [
-        [InlineKeyboardButton("English 🇬🇧", callback_data='lang_en')],
-        [InlineKeyboardButton("বাংলা 🇧🇩", callback_data='lang_bn')],
-        [InlineKeyboardButton("Español 🇪🇸", callback_data='lang_es')],
-        [InlineKeyboardButton("Bahasa Indonesia 🇮🇩", callback_data='lang_id')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    messages = {
-        'en': "Please choose your language:",
-        'bn': "আপনার ভাষা নির্বাচন করুন:",
-        'es': "Por favor, elige tu idioma:",
-        'id': "Silakan pilih bahasa Anda:"
-    }
-    
-    await (update.message or update.callback_query).reply_text(
-        messages.get(user_lang, messages['en']), reply_markup=reply_markup
+    user_lang = user_data.get('language', DEFAULT_LANGUAGE)
+
+    await outbox.reply(
+        update.effective_message,
+        catalog.text(user_lang, 'choose_language'), reply_markup=catalog.keyboard(user_lang, 'languages')
     )
 
+@instrument('language_callback')
 async def handle_language_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     user_id = query.from_user.id
-    lang_code = query.data.split('_')[1]
+    lang_code = catalog.resolve(query.data.split('_')[1])
 
     await update_user_data(user_id, language=lang_code)
-    
-    messages = {
-        'en': "Language set to English. Now, let's explore PixiGPT!",
-        'bn': "ভাষা বাংলাতে সেট করা হয়েছে। এবার চলুন PixiGPT এক্সপ্লোর করি!",
-        'es': "Idioma configurado a Español. ¡Ahora, exploremos PixiGPT!",
-        'id': "Bahasa diatur ke Bahasa Indonesia. Sekarang, mari jelajahi PixiGPT!"
-    }
+
     await query.answer()
-    await query.edit_message_text(messages.get(lang_code, messages['en']))
-    await set_bot_commands(context.bot) # কমান্ড সেট করা হয়েছে
+    await outbox.edit_query(query, catalog.text(lang_code, 'language_set'))
     await send_main_menu(update, context)
 
 
 async def send_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     user_data = await get_user_data(user_id)
-    user_lang = user_data.get('language', 'en')
-
-    messages = {
-        'en': "What would you like to do?",
-        'bn': "আপনি কি করতে চান?",
-        'es': "¿Qué te gustaría hacer?",
-        'id': "Apa yang ingin Anda lakukan?"
-    }
-
-    keyboard = [
-        [InlineKeyboardButton("💬 Chat with AI", callback_data='chat_ai')],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await (update.message or update.callback_query).reply_text(
-        messages.get(user_lang, messages['en']), reply_markup=reply_markup
+    user_lang = user_data.get('language', DEFAULT_LANGUAGE)
+
+    await outbox.reply(
+        update.effective_message,
+        catalog.text(user_lang, 'main_menu'), reply_markup=catalog.keyboard(user_lang, 'main_menu')
     )
 
 
+@instrument('main_menu_callback')
 async def handle_main_menu_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    # context.user_data ব্যবহার করার আগে নিশ্চিত করুন user_data লোড হয়েছে
-    # user_data = await get_user_data(user_id) # যদি এখানে দরকার হয়
 
     if query.data == 'chat_ai':
-        chat_messages = {
-            'en': "You can now chat with PixiGPT. Type your message:",
-            'bn': "এখন আপনি PixiGPT-এর সাথে চ্যাট করতে পারবেন। আপনার মেসেজ টাইপ করুন:",
-            'es': "Ahora puedes chatear con PixiGPT. Escribe tu mensaje:",
-            'id': "Anda sekarang dapat mengobrol dengan PixiGPT. Ketik pesan Anda:"
-        }
-        await query.edit_message_text(chat_messages.get('en', chat_messages['en'])) # ভাষা নির্দিষ্ট করে দেওয়া হয়েছে
+        user_data = await get_user_data(user_id)
+        user_lang = user_data.get('language', DEFAULT_LANGUAGE) if user_data else DEFAULT_LANGUAGE
+        await outbox.edit_query(query, catalog.text(user_lang, 'chat_mode_prompt'))
         context.user_data['current_mode'] = 'chat_ai'
 
 
+@instrument('message')
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not await check_channel_membership(update, context):
         return
 
     user_id = update.effective_user.id
     user_data = await get_user_data(user_id)
-    user_lang = user_data.get('language', 'en')
-    current_plan = user_data.get('plan_type', 'free')
-    daily_msg_count = user_data.get('daily_message_count', 0)
-    last_msg_date_str = user_data.get('last_message_date', datetime.now().strftime('%Y-%m-%d'))
-    
-    today_str = datetime.now().strftime('%Y-%m-%d')
-    if last_msg_date_str != today_str:
-        daily_msg_count = 0
-        await update_user_data(user_id, daily_message_count=0, last_message_date=today_str)
-
-    message_limit = FREE_MESSAGE_LIMIT if current_plan == 'free' else PREMIUM_MESSAGE_LIMIT
+    user_lang = user_data.get('language', DEFAULT_LANGUAGE)
 
     if 'current_mode' in context.user_data and context.user_data['current_mode'] == 'chat_ai':
-        if daily_msg_count >= message_limit:
-            quota_messages = {
-                'en': (
-                    "You have reached your daily message limit. "
-                    "Upgrade to premium for unlimited messages, or wait until tomorrow!"
-                ),
-                'bn': (
-                    "আপনার দৈনিক মেসেজ সীমা পৌঁছে গেছে। "
-                    "আনলিমিটেড মেসেজের জন্য প্রিমিয়ামে আপগ্রেড করুন, অথবা আগামীকালের জন্য অপেক্ষা করুন!"
-                ),
-                'es': (
-                    "Has alcanzado tu límite diario de mensajes. "
-                    "¡Actualiza a premium para mensajes ilimitados, o espera hasta mañana!"
-                ),
-                'id': (
-                    "Anda telah mencapai batas pesan harian Anda. "
-                    "Tingkatkan ke premium untuk pesan tanpa batas, atau tunggu sampai besok!"
-                )
-            }
-            await update.message.reply_text(quota_messages.get(user_lang, quota_messages['en']))
+        # জেমিনি কলের আগেই একটি মেসেজ সংরক্ষণ করা হয়, ব্যর্থ হলে ফেরত দেওয়া হবে
+        plan = user_data.get('plan_type', 'free')
+        reservation = await quota.reserve(user_id)
+        if reservation is None:
+            metrics.inc('quota_rejections_total', plan=plan)
+            await outbox.reply(update.message, catalog.text(user_lang, 'quota_reached'), PRIORITY_ANSWER)
             return
 
         user_message = update.message.text
-        processing_messages = {
-            'en': "Thinking...",
-            'bn': "ভাবছি...",
-            'es': "Pensando...",
-            'id': "Sedang berpikir..."
-        }
-        await update.message.reply_text(processing_messages.get(user_lang, processing_messages['en']))
+        # প্ল্যান ও প্রশ্নের দৈর্ঘ্য অনুযায়ী মডেল বাছাই; ক্যাশ কী-তেও সেই মডেলের নাম থাকে
+        model_name = router.primary(plan, len(user_message))
+
+        # হিস্টোরি ছাড়া ছোট প্রশ্নের উত্তর ক্যাশ থেকে দেওয়া যায়
+        cache_key = None
+        if RESPONSE_CACHE and len(user_message) <= RESPONSE_CACHE_MAX_PROMPT_CHARS:
+            if CONVERSATION_MEMORY and conversations.has_history(user_id):
+                response_cache.bypassed += 1
+            else:
+                cache_key = response_cache.key(user_message, user_lang, model_name)
+
+        if cache_key is not None:
+            cached_response = response_cache.get(cache_key)
+            if cached_response is not None:
+                await send_complete_reply(None, update.message, cached_response)
+                if CONVERSATION_MEMORY:
+                    conversations.add_exchange(user_id, user_message, cached_response)
+                return
+
+        # উত্তর খুব দ্রুত এলে "Thinking..." পাঠানোই হয় না
+        placeholder = DelayedPlaceholder(update.message, catalog.text(user_lang, 'thinking'))
+
+        if cache_key is not None:
+            # একই প্রশ্ন অন্য কারো জন্য এই মুহূর্তে তৈরি হচ্ছে থাকলে সেটার জন্য অপেক্ষা
+            in_flight = response_cache.join(cache_key)
+            if in_flight is not None:
+                # একজন অপেক্ষমাণ বাতিল হলে শেয়ার করা future টি বাতিল হয়ে বাকিদের উত্তর আটকে না যায়
+                cached_response = await asyncio.shield(in_flight)
+                if cached_response is not None:
+                    await send_complete_reply(placeholder, update.message, cached_response)
+                    if CONVERSATION_MEMORY:
+                        conversations.add_exchange(user_id, user_message, cached_response)
+                    return
+            response_cache.lead(cache_key)
+
+        if CONVERSATION_MEMORY:
+            prompt = conversations.build_contents(user_id, user_message)
+        else:
+            prompt = user_message
 
+        models = router.route(plan, len(user_message))
+        answered_by = []
+        ai_response = None
         try:
-            response = gemini_model.generate_content(user_message)
-            ai_response = response.text
-        except Exception as e:
-            print(f"Error calling Gemini API: {e}")
-            error_messages = {
-                'en': "Sorry, I couldn't process your request right now. Please try again later.",
-                'bn': "দুঃখিত, আমি এই মুহূর্তে আপনার অনুরোধ প্রক্রিয়া করতে পারিনি। অনুগ্রহ করে পরে আবার চেষ্টা করুন।",
-                'es': "Lo siento, no pude procesar tu solicitud en este momento. Por favor, inténtalo de nuevo más tarde.",
-                'id': "Maaf, saya tidak dapat memproses permintaan Anda saat ini. Silakan coba lagi nanti."
-            }
-            ai_response = error_messages.get(user_lang, error_messages['en'])
-        
-        await update.message.reply_text(ai_response)
-        
-        await update_user_data(user_id, daily_message_count=daily_msg_count + 1)
+            if STREAM_RESPONSES:
+                reply = StreamingReply(placeholder, update.message)
+                error_text = None
+                try:
+                    async with contextlib.aclosing(inference.stream(prompt, plan, models, answered_by.append)) as chunks:
+                        async for chunk in chunks:
+                            await reply.push(chunk)
+                    await reply.finish()
+                    if reply.total_length == 0:
+                        error_text = catalog.text(user_lang, 'error')
+                    else:
+                        ai_response = reply.text
+                except InferenceOverloaded:
+                    print(f"Gemini queue is full, rejecting message from user {user_id}")
+                    error_text = catalog.text(user_lang, 'busy')
+                except Exception as e:
+                    print(f"Error calling Gemini API: {e!r}")
+                    error_text = catalog.text(user_lang, 'error')
+                if error_text:
+                    await quota.refund(user_id, reservation)
+                    await reply.fail(error_text)
+            else:
+                try:
+                    ai_response = await inference.generate(prompt, plan, models, answered_by.append)
+                    reply_text = ai_response
+                except InferenceOverloaded:
+                    print(f"Gemini queue is full, rejecting message from user {user_id}")
+                    await quota.refund(user_id, reservation)
+                    reply_text = catalog.text(user_lang, 'busy')
+                except Exception as e:
+                    print(f"Error calling Gemini API: {e!r}")
+                    await quota.refund(user_id, reservation)
+                    reply_text = catalog.text(user_lang, 'error')
+
+                await send_complete_reply(placeholder, update.message, reply_text)
+        finally:
+            if cache_key is not None:
+                # ফেইলওভারের উত্তর মূল মডেলের কী-তে জমা রাখা হয় না; অপেক্ষমাণরা অবশ্য এটাই পায়
+                response_cache.finish(cache_key, ai_response, store=answered_by == [model_name])
+
+        if ai_response and CONVERSATION_MEMORY:
+            conversations.add_exchange(user_id, user_message, ai_response)
 
     else:
         await send_main_menu(update, context)
 
+@instrument('account')
 async def account_info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     user_data = await get_user_data(user_id)
     if not user_data:
-        await update.message.reply_text("আপনার অ্যাকাউন্ট তথ্য পাওয়া যায়নি। /start দিয়ে শুরু করুন।")
+        user_lang = catalog.resolve(update.effective_user.language_code)
+        await outbox.reply(update.message, catalog.text(user_lang, 'account_not_found'))
         return
 
-    user_name = user_data.get('telegram_name', 'User')
-    user_lang = user_data.get('language', 'en')
-    plan_type = user_data.get('plan_type', 'free')
-    daily_msg_count = user_data.get('daily_message_count', 0)
-    last_msg_date_str = user_data.get('last_message_date', datetime.now().strftime('%Y-%m-%d'))
-    referral_code = user_data.get('referral_code', f"REF{user_id}")
-    referred_by_id = user_data.get('referred_by_id')
-    referral_points = user_data.get('referral_points', 0)
-
-    today_str = datetime.now().strftime('%Y-%m-%d')
-    if last_msg_date_str != today_str:
-        daily_msg_count = 0
-        await update_user_data(user_id, daily_message_count=0, last_message_date=today_str)
-
-    message_limit = FREE_MESSAGE_LIMIT if plan_type == 'free' else PREMIUM_MESSAGE_LIMIT
-    
-    messages = {
-        'en': (
-            "**Account Information:**\n"
-            f"Telegram Name: `{user_name}`\n"
-            f"Current Plan: `{plan_type.capitalize()}`\n"
-            f"Messages Used Today: `{daily_msg_count}/{message_limit}`\n"
-            f"Referral Points: `{referral_points}`\n\n"
-            "To upgrade to premium for unlimited messages, contact admin: @rs_fahim_crypto"
-        ),
-        'bn': (
-            "**অ্যাকাউন্ট তথ্য:**\n"
-            f"টেলিগ্রাম নাম: `{user_name}`\n"
-            f"বর্তমান প্ল্যান: `{plan_type.capitalize()}`\n"
-            f"আজকের ব্যবহৃত মেসেজ: `{daily_msg_count}/{message_limit}`\n"
-            f"রেফারেল পয়েন্ট: `{referral_points}`\n\n"
-            "আনলিমিটেড মেসেজের জন্য প্রিমিয়ামে আপগ্রেড করতে, অ্যাডমিনের সাথে যোগাযোগ করুন: @rs_fahim_crypto"
-        ),
-        'es': (
-            "**Información de la cuenta:**\n"
-            f"Nombre de Telegram: `{user_name}`\n"
-            f"Plan actual: `{plan_type.capitalize()}`\n"
-            f"Mensajes usados hoy: `{daily_msg_count}/{message_limit}`\n"
-            f"Puntos de referencia: `{referral_points}`\n\n"
-            "Para actualizar a premium para mensajes ilimitados, contacta al administrador: @rs_fahim_crypto"
+    user_lang = user_data.get('language', DEFAULT_LANGUAGE)
+    await outbox.reply(
+        update.message,
+        catalog.text(
+            user_lang, 'account_info',
+            user_name=user_data.get('telegram_name', 'User'),
+            plan=user_data.get('plan_type', 'free').capitalize(),
+            used=quota.used_today(user_data),
+            limit=quota.limit_for(user_data),
+            points=await get_referral_points(user_id, user_data),
         ),
-        'id': (
-            "**Informasi Akun:**\n"
-            f"Nama Telegram: `{user_name}`\n"
-            f"Paket Saat Ini: `{plan_type.capitalize()}`\n"
-            f"Pesan yang Digunakan Hari Ini: `{daily_msg_count}/{message_limit}`\n"
-            f"Poin Referral: `{referral_points}`\n\n"
-            "Untuk meningkatkan ke premium untuk pesan tak terbatas, hubungi admin: @rs_fahim_crypto"
-        )
-    }
-    await update.message.reply_text(messages.get(user_lang, messages['en']), parse_mode='Markdown')
+        parse_mode='Markdown'
+    )
 
+@instrument('referral')
 async def generate_referral_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     user_data = await get_user_data(user_id)
-    user_lang = user_data.get('language', 'en')
 
     if not user_data:
-        await update.message.reply_text("আপনার অ্যাকাউন্ট তথ্য পাওয়া যায়নি। /start দিয়ে শুরু করুন।")
+        user_lang = catalog.resolve(update.effective_user.language_code)
+        await outbox.reply(update.message, catalog.text(user_lang, 'account_not_found'))
         return
 
+    user_lang = user_data.get('language', DEFAULT_LANGUAGE)
     referral_code = user_data.get('referral_code', f"REF{user_id}")
     # যদি রেফারেল কোড না থাকে, তাহলে তৈরি করুন
     if user_data.get('referral_code') is None:
@@ -421,22 +2724,365 @@ async def generate_referral_code(update: Update, context: ContextTypes.DEFAULT_T
         
     referral_link = f"https://t.me/{context.bot.username}?start={referral_code}"
 
-    messages = {
-        'en': (
-            "**Your Referral System:**\n"
-            "Share this link with your friends to earn points!\n"
-            f"Your Referral Link: `{referral_link}`\n"
-            f"Your Referral Code: `{referral_code}`\n\n"
-            "You get 2 points for each successful referral."
+    await outbox.reply(
+        update.message,
+        catalog.text(
+            user_lang, 'referral_info',
+            referral_link=referral_link, referral_code=referral_code, points=REFERRAL_POINTS
         ),
-        'bn': (
-            "**আপনার রেফারেল সিস্টেম:**\n"
-            "পয়েন্ট অর্জনের জন্য আপনার বন্ধুদের সাথে এই লিঙ্কটি শেয়ার করুন!\n"
-            f"আপনার রেফারেল লিঙ্ক: `{referral_link}`\n"
-            f"আপনার রেফারেল কোড: `{referral_code}`\n\n"
-            "প্রতিটি সফল রেফারে আপনি 2 পয়েন্ট পাবেন।"
-        ),
-        'es': (
-            "**Tu sistema de referidos:**\n"
-            "¡Comparte este enlace con tus amigos para ganar puntos!\n"
-            f"Tu enlace de referi
+        parse_mode='Markdown'
+    )
+
+
+@instrument('stats')
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # শুধুমাত্র অ্যাডমিনদের জন্য: ইনফারেন্স লেয়ারের কাউন্টার দেখা
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        return
+
+    # লেগেসি Markdown এ কী-এর _ ইটালিক হিসেবে পড়া হয়, তাই পুরো লাইনটাই কোড স্প্যানে
+    lines = ["*Inference:*"]
+    lines += [f"`{key}: {value}`" for key, value in inference.stats().items()]
+    lines += ["", "*Model router:*"]
+    lines += [f"`{key}: {value}`" for key, value in router.stats().items()]
+    lines += ["", "*Profile cache:*"]
+    lines += [f"`{key}: {value}`" for key, value in profile_cache.stats().items()]
+    lines += ["", "*Quota:*"]
+    lines += [f"`{key}: {value}`" for key, value in quota.stats().items()]
+    lines += ["", "*Channel membership cache:*"]
+    lines += [f"`{key}: {value}`" for key, value in membership_cache.stats().items()]
+    lines += ["", "*Conversations:*"]
+    lines += [f"`{key}: {value}`" for key, value in conversations.stats().items()]
+    lines += ["", "*Response cache:*"]
+    lines += [f"`{key}: {value}`" for key, value in response_cache.stats().items()]
+    lines += ["", "*Outbound messages:*"]
+    lines += [f"`{key}: {value}`" for key, value in outbox.stats().items()]
+    lines += ["", "*Maintenance jobs:*"]
+    lines += [f"`{key}: {value}`" for key, value in maintenance.stats().items()]
+    lines += ["", "*Startup:*"]
+    lines += [f"`{kind} {name}: {seconds * 1000:.0f} ms`" for kind, name, seconds in startup_timings]
+    await outbox.reply(update.message, "\n".join(lines), parse_mode='Markdown')
+
+
+async def warm_up_clients():
+    # জেমিনি মডেল আর স্টোরেজ ক্লায়েন্ট একসাথে তৈরি, যাতে প্রথম ইউজারকে অপেক্ষা করতে না হয়।
+    # ভারী ইমপোর্ট ও সার্ভিস অ্যাকাউন্ট পার্স থ্রেডে চলে; Firestore এর AsyncClient লুপেই তৈরি হয়।
+    started = time.perf_counter()
+    jobs = [asyncio.to_thread(inference.warm_up)]
+    if STORAGE_BACKEND == 'firestore':
+        jobs.append(asyncio.to_thread(get_firebase_app))
+    else:
+        jobs.append(asyncio.to_thread(get_storage))
+    await asyncio.gather(*jobs)
+    get_storage()
+    print(f"{startup_report()}; warm-up wall time {(time.perf_counter() - started) * 1000:.0f} ms")
+
+
+async def post_init(application: Application) -> None:
+    await warm_up_clients()
+    profile_cache.start()
+    schedule_maintenance(application)
+    await metrics_exporter.start(WORKER_INDEX)
+
+
+async def post_shutdown(application: Application) -> None:
+    # বন্ধ হওয়ার আগে সারিতে থাকা মেসেজ পাঠানো ও জমে থাকা প্রোফাইল পরিবর্তনগুলো লিখে ফেলা
+    await metrics_exporter.close()
+    await outbox.close()
+    await profile_cache.close()
+    await close_storage()
+    await conversations.close()
+
+
+def build_application(token=None, request=None, model_factory=None) -> Application:
+    # অ্যাপ্লিকেশন ফ্যাক্টরি: ইমপোর্টে কোনো ক্লায়েন্ট তৈরি হয় না, সব post_init এ।
+    # request ও model_factory (মডেলের নাম -> মডেল) দিয়ে টেস্টে নেটওয়ার্ক ছাড়া নকল Bot API ও জেমিনি বসানো যায়।
+    if model_factory is not None:
+        inference.set_model_factory(model_factory)
+
+    # concurrent_updates চালু না থাকলে একটি ধীর জেমিনি কল বাকি সব আপডেট আটকে রাখে
+    builder = (
+        Application.builder()
+        .token(token or TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    # ডিফল্ট রিকোয়েস্টের মতোই বড় কানেকশন পুল, সাথে প্রতিটি Bot API কলের মেট্রিক্স
+    builder = builder.request(request or InstrumentedRequest(connection_pool_size=256))
+    application = builder.build()
+
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("account", account_info))
+    application.add_handler(CommandHandler("language", language_selection))
+    application.add_handler(CommandHandler("referral", generate_referral_code))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CallbackQueryHandler(handle_language_callback, pattern='^lang_'))
+    application.add_handler(CallbackQueryHandler(handle_main_menu_callback, pattern='^chat_ai$'))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(ChatMemberHandler(handle_channel_member_update, ChatMemberHandler.CHAT_MEMBER))
+    return application
+
+
+# --- ওয়েবহুক মোড ---
+# WEBHOOK_URL দেওয়া থাকলে পোলিংয়ের বদলে একটি HTTP সার্ভার আপডেট গ্রহণ করে। আপডেটগুলো user_id
+# অনুযায়ী WEBHOOK_WORKERS টি প্রসেসে ভাগ হয়, ফলে একজন ইউজারের সব আপডেট সবসময় একই প্রসেসে যায়:
+# তার মেসেজের ক্রম ঠিক থাকে এবং প্রসেসের ভেতরের ক্যাশ ও কোটা গণনাও সঠিক থাকে।
+
+def update_shard_key(data):
+    # কাঁচা আপডেট JSON থেকে ইউজার আইডি বের করা (Update অবজেক্ট না বানিয়েই)
+    for field, value in data.items():
+        if not isinstance(value, dict):
+            continue
+        if field in ('chat_member', 'my_chat_member'):
+            # মেম্বারশিপ ক্যাশ যে প্রসেসে ইউজারটি আছে সেখানেই বদলাতে হবে
+            return value.get('new_chat_member', {}).get('user', {}).get('id', 0)
+        sender = value.get('from') or value.get('user') or value.get('chat')
+        if isinstance(sender, dict) and 'id' in sender:
+            return sender['id']
+    return 0
+
+
+class UpdateDispatcher:
+    # একই ইউজারের আপডেট একটির পর একটি, ভিন্ন ইউজারের আপডেট একসাথে প্রসেস করা
+    def __init__(self, application):
+        self.application = application
+        self._locks = {} # user_id -> asyncio.Lock
+        self._pending = {} # user_id -> অপেক্ষমাণ আপডেটের সংখ্যা
+        self._tasks = set()
+        self.processed = 0
+
+    def submit(self, data):
+        try:
+            update = Update.de_json(data, self.application.bot)
+        except Exception as e:
+            print(f"Ignoring malformed update: {e!r}")
+            return
+        key = update_shard_key(data)
+        task = asyncio.ensure_future(self._process(key, update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, key, update):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._pending[key] = self._pending.get(key, 0) + 1
+        try:
+            async with lock:
+                await self.application.process_update(update)
+            self.processed += 1
+        except Exception as e:
+            print(f"Error processing update {update.update_id}: {e!r}")
+        finally:
+            self._pending[key] -= 1
+            if not self._pending[key]:
+                del self._pending[key]
+                del self._locks[key]
+
+    def depth(self):
+        return len(self._tasks)
+
+    async def drain(self, timeout=None):
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(list(self._tasks), timeout=timeout)
+        if pending:
+            # ধীর জেমিনি কলের জন্য প্রোফাইল ফ্লাশ বাদ পড়তে দেওয়া যাবে না
+            print(f"{len(pending)} update(s) still running after {timeout:g}s, cancelling them")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def start_dispatcher():
+    application = build_application()
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    return UpdateDispatcher(application)
+
+
+async def stop_dispatcher(dispatcher):
+    await dispatcher.drain(WEBHOOK_DRAIN_TIMEOUT)
+    await dispatcher.application.stop()
+    await post_shutdown(dispatcher.application)
+    await dispatcher.application.shutdown()
+
+
+class LocalShard:
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+
+    def submit(self, data):
+        self.dispatcher.submit(data)
+
+    def health(self):
+        return {'alive': True, 'queued': self.dispatcher.depth(), 'processed': self.dispatcher.processed}
+
+    async def close(self):
+        await stop_dispatcher(self.dispatcher)
+
+
+class ProcessShard:
+    def __init__(self, index, mp_context):
+        self.index = index
+        self.queue = mp_context.Queue()
+        self.process = mp_context.Process(
+            target=run_webhook_worker, args=(index, self.queue), name=f"pixigpt-worker-{index}", daemon=True
+        )
+        self.process.start()
+
+    def submit(self, data):
+        self.queue.put(data)
+
+    def health(self):
+        try:
+            queued = self.queue.qsize()
+        except NotImplementedError:
+            queued = None
+        return {'alive': self.process.is_alive(), 'queued': queued}
+
+    async def close(self):
+        self.queue.put(None)
+        await asyncio.to_thread(self.process.join, WEBHOOK_SHUTDOWN_TIMEOUT)
+        if self.process.is_alive():
+            print(f"Webhook worker {self.index} did not stop within {WEBHOOK_SHUTDOWN_TIMEOUT:g}s")
+
+
+def run_webhook_worker(index, updates):
+    # প্রতিটি ওয়ার্কার প্রসেসের নিজস্ব Application ও ক্লায়েন্ট থাকে
+    global WORKER_INDEX
+    WORKER_INDEX = index
+
+    # Heroku বন্ধের সময় ডাইনোর সব প্রসেসে SIGTERM পাঠায় (টার্মিনালে Ctrl+C ও পুরো গ্রুপে SIGINT)।
+    # ডিফল্ট আচরণে ওয়ার্কার সাথে সাথে মরে যেত, প্রোফাইল ফ্লাশ হত না। তাই সিগন্যাল উপেক্ষা করে
+    # প্যারেন্টের None এর অপেক্ষা; প্যারেন্ট হঠাৎ মরে গেলেও নিজে থেকে বন্ধ হয়।
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    parent = multiprocessing.parent_process()
+
+    def next_update():
+        while True:
+            try:
+                return updates.get(timeout=1)
+            except QueueEmpty:
+                if parent is not None and not parent.is_alive():
+                    return None
+
+    async def serve():
+        dispatcher = await start_dispatcher()
+        loop = asyncio.get_running_loop()
+        print(f"Webhook worker {index} is running...")
+        try:
+            while True:
+                data = await loop.run_in_executor(None, next_update)
+                if data is None:
+                    break
+                dispatcher.submit(data)
+        finally:
+            await stop_dispatcher(dispatcher)
+
+    asyncio.run(serve())
+
+
+class UpdateRouter:
+    def __init__(self, shards):
+        self.shards = shards
+        self.routed = 0
+
+    def route(self, data):
+        shard = self.shards[update_shard_key(data) % len(self.shards)]
+        shard.submit(data)
+        self.routed += 1
+
+    def health(self):
+        shards = [shard.health() for shard in self.shards]
+        return {
+            'status': 'ok' if all(shard['alive'] for shard in shards) else 'degraded',
+            'routed': self.routed,
+            'shards': shards,
+        }
+
+
+async def serve_webhook():
+    # tornado python-telegram-bot[webhooks] এর সাথে আসে
+    import tornado.web
+
+    class TelegramWebhookHandler(tornado.web.RequestHandler):
+        def initialize(self, router):
+            self.router = router
+
+        def post(self):
+            if WEBHOOK_SECRET and self.request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+                self.set_status(403)
+                return
+            try:
+                data = json.loads(self.request.body)
+            except ValueError:
+                self.set_status(400)
+                return
+            self.router.route(data)
+
+    class HealthHandler(tornado.web.RequestHandler):
+        def initialize(self, router):
+            self.router = router
+
+        def get(self):
+            health = self.router.health()
+            self.set_status(200 if health['status'] == 'ok' else 503)
+            self.write(health)
+
+    if WEBHOOK_WORKERS > 1:
+        # fork করা প্রসেসে gRPC ক্লায়েন্ট নিরাপদ নয়, তাই spawn
+        mp_context = multiprocessing.get_context('spawn')
+        shards = [ProcessShard(index, mp_context) for index in range(WEBHOOK_WORKERS)]
+    else:
+        shards = [LocalShard(await start_dispatcher())]
+    router = UpdateRouter(shards)
+
+    web_app = tornado.web.Application([
+        (WEBHOOK_PATH, TelegramWebhookHandler, {'router': router}),
+        (r'/healthz', HealthHandler, {'router': router}),
+    ])
+    server = web_app.listen(WEBHOOK_PORT, address=WEBHOOK_LISTEN)
+
+    if WEBHOOK_URL:
+        bot = Bot(TELEGRAM_BOT_TOKEN)
+        async with bot:
+            await bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES,
+            )
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    print(f"PixiGPT webhook server is listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT} with {len(shards)} worker(s)...")
+    await stop_event.wait()
+
+    server.stop()
+    for shard in shards:
+        await shard.close()
+
+
+record_startup('import', 'pixi_gpt_bot module body', _module_import_started)
+
+
+def main() -> None:
+    check_environment()
+    if WEBHOOK_URL or WEBHOOK_MODE:
+        asyncio.run(serve_webhook())
+        return
+
+    application = build_application()
+    print("PixiGPT bot is running...")
+    # chat_member আপডেট ডিফল্টে আসে না, তাই সব ধরনের আপডেট চাওয়া হচ্ছে
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# ওয়েবহুক সার্ভারে রেকর্ড করা Update JSON পাঠানোর লোকাল হারনেস।
+#
+# সার্ভার চালান (setWebhook ছাড়া):
+#     WEBHOOK_MODE=1 WEBHOOK_WORKERS=2 python pixi_gpt_bot.py
+# তারপর:
+#     python replay_updates.py samples/updates.jsonl --repeat 50 --users 20
+#
+# --users দিলে প্রতিটি রিপিটে ইউজার আইডি বদলে দেওয়া হয়, যাতে একাধিক ওয়ার্কারে লোড ভাগ হয়।
+# একজন ইউজারের আপডেটগুলো রেকর্ডের ক্রমে একটির পর একটি যায় (যেমন /start এর আগে মেসেজ নয়);
+# --concurrency শুধু ভিন্ন ইউজারদের মধ্যে সমান্তরাল।
+
+import argparse
+import copy
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def load_updates(path):
+    with open(path, encoding='utf-8') as f:
+        text = f.read().strip()
+    if text.startswith('['):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def rewrite_user(value, old_id, new_id):
+    # রেকর্ড করা আপডেটের ভেতরের সব ইউজার/চ্যাট আইডি বদলে দেওয়া
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key == 'id' and item == old_id:
+                value[key] = new_id
+            else:
+                rewrite_user(item, old_id, new_id)
+    elif isinstance(value, list):
+        for item in value:
+            rewrite_user(item, old_id, new_id)
+
+
+def first_user_id(update):
+    for value in update.values():
+        if isinstance(value, dict) and isinstance(value.get('from'), dict):
+            return value['from']['id']
+    return None
+
+
+def build_stream(updates, repeat, users):
+    update_id = 0
+    for round_index in range(repeat):
+        for update in updates:
+            update = copy.deepcopy(update)
+            update_id += 1
+            update['update_id'] = update_id
+            user_id = first_user_id(update)
+            if users and user_id is not None:
+                rewrite_user(update, user_id, user_id + round_index % users)
+            yield update
+
+
+def group_by_user(stream):
+    groups = {}
+    for update in stream:
+        groups.setdefault(first_user_id(update), []).append(update)
+    return list(groups.values())
+
+
+def post(url, secret, update):
+    request = urllib.request.Request(url, data=json.dumps(update).encode(), method='POST')
+    request.add_header('Content-Type', 'application/json')
+    if secret:
+        request.add_header('X-Telegram-Bot-Api-Secret-Token', secret)
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except urllib.error.URLError as e:
+        status = f"error: {e.reason}"
+    return status, time.perf_counter() - started
+
+
+def post_in_order(url, secret, updates):
+    return [post(url, secret, update) for update in updates]
+
+
+def get_health(base_url):
+    try:
+        with urllib.request.urlopen(base_url + '/healthz', timeout=5) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        # ভুল --url দিলে সাধারণত JSON ছাড়া 404 আসে
+        try:
+            return json.loads(e.read() or b'{}')
+        except ValueError:
+            return {'status': f"HTTP {e.code}"}
+    except urllib.error.URLError as e:
+        return {'status': f"unreachable: {e.reason}"}
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded Telegram updates against the PixiGPT webhook server.")
+    parser.add_argument('file', help="JSON array or JSON lines file with recorded updates")
+    parser.add_argument('--url', default=f"http://127.0.0.1:{os.environ.get('PORT', '8443')}")
+    parser.add_argument('--path', default=os.environ.get('WEBHOOK_PATH', '/telegram'))
+    parser.add_argument('--secret', default=os.environ.get('WEBHOOK_SECRET', ''))
+    parser.add_argument('--repeat', type=int, default=1, help="how many times to replay the file")
+    parser.add_argument('--users', type=int, default=0, help="spread repeats over this many synthetic users")
+    parser.add_argument('--concurrency', type=int, default=8, help="users replayed in parallel")
+    args = parser.parse_args()
+
+    base_url = args.url.rstrip('/')
+    print("health before:", json.dumps(get_health(base_url)))
+
+    updates = load_updates(args.file)
+    statuses = {}
+    latencies = []
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = pool.map(lambda group: post_in_order(base_url + args.path, args.secret, group),
+                           group_by_user(build_stream(updates, args.repeat, args.users)))
+        for group_results in results:
+            for status, latency in group_results:
+                statuses[status] = statuses.get(status, 0) + 1
+                latencies.append(latency)
+    elapsed = time.perf_counter() - started
+
+    print(f"sent {len(latencies)} updates in {elapsed:.2f}s ({len(latencies) / elapsed:.1f}/s)")
+    print("status codes:", statuses)
+    print(f"latency p50={percentile(latencies, 0.5) * 1000:.1f}ms p95={percentile(latencies, 0.95) * 1000:.1f}ms")
+    print("health after:", json.dumps(get_health(base_url)))
+
+
+if __name__ == '__main__':
+    main()